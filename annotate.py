@@ -1,50 +1,144 @@
 import fitz
+import logging
+import numpy as np
 import pandas as pd
 import ast
 import re
 import os
+import string
+from bisect import bisect_right
+from itertools import groupby
+from functools import lru_cache
+from flashtext import KeywordProcessor
 from logging_config import logger
 
+_QUESTION_RE = re.compile(r'(?<!\d)\d+\.\d+(?:\([a-z]\))?(?!\d)')
+_SCORE_KW_RE = re.compile(r'marks|/|score|total', re.IGNORECASE)
+
+def build_page_text(words):
+    """
+    Join the words of a page (tuples shaped like get_text("words"), see read_page)
+    into one lowercase string so repeated lookups can use str.find instead of
+    page.search_for.
+    Returns (text, starts, spans) where spans[i] = (end, rect, (block, line)).
+    """
+    parts = []
+    starts = []
+    spans = []
+    pos = 0
+    for x0, y0, x1, y1, word, block_no, line_no, _ in words:
+        word = word.lower()
+        if parts:
+            pos += 1
+        starts.append(pos)
+        spans.append((pos + len(word), fitz.Rect(x0, y0, x1, y1), (block_no, line_no)))
+        parts.append(word)
+        pos += len(word)
+    return " ".join(parts), starts, spans
+
+def search_page_text(page_text, needle, first_only=False):
+    """
+    Case-insensitive replacement for page.search_for over a cached page text.
+    Returns one rect per text line covered by each match.
+    """
+    text = page_text[0]
+    needle = " ".join(needle.lower().split())
+    if not needle:
+        return []
+
+    rects = []
+    pos = text.find(needle)
+    while pos != -1:
+        end = pos + len(needle)
+        rects.extend(text_range_rects(page_text, pos, end))
+        if first_only:
+            break
+        pos = text.find(needle, end)
+    return rects
+
+def text_range_rects(page_text, start, end):
+    """Map a [start, end) character range of a cached page text to one rect per text line."""
+    _, starts, spans = page_text
+    rects = []
+    i = bisect_right(starts, start) - 1
+    line_rect, line_key = None, None
+    while i < len(starts) and starts[i] < end:
+        _, rect, key = spans[i]
+        if key != line_key:
+            if line_rect is not None:
+                rects.append(line_rect)
+            line_rect, line_key = fitz.Rect(rect), key
+        else:
+            line_rect |= rect
+        i += 1
+    if line_rect is not None:
+        rects.append(line_rect)
+    return rects
+
+def build_keyword_processor(phrases):
+    """Build one FlashText automaton holding every correct word/phrase."""
+    keyword_processor = KeywordProcessor()
+    for phrase in phrases:
+        normalized = " ".join(phrase.split())
+        if normalized:
+            keyword_processor.add_keyword(normalized)
+    return keyword_processor
+
+@lru_cache(maxsize=8)
+def get_font(fontname):
+    """Load a font once and reuse it; fitz.Font parses the font program on construction."""
+    return fitz.Font(fontname=fontname)
+
 def insert_wrapped_text(page, x, y, text, max_width, fontsize, color, fontname, y_limit):
     """Insert wrapped text at (x,y), clipped so it won't cross y_limit."""
     try:
-        font = fitz.Font(fontname=fontname)
+        font = get_font(fontname)
         words = text.split()
-        current_line = ""
-        lines = []
         line_height = fontsize + 2
-
+        # Number of lines that fit above y_limit; stop wrapping once they are filled
+        max_lines = max(0, int((y_limit - y) // line_height))
+
+        # Greedy wrap on the cumulative width of each word plus its trailing space:
+        # a line starting at word `start` ends before the first word whose
+        # cumulative width exceeds the line budget
+        space_w = font.text_length(" ", fontsize=fontsize)
+        line_w = max_width + space_w
+        # Measure only the words that can still reach one of the max_lines lines. Each
+        # line takes at most line_w of cumulative width, except a wider word, which
+        # sits alone on its line and pushes the budget out by its excess
+        budget = max_lines * line_w
+        widths = []
+        total = 0.0
         for word in words:
-            test_line = current_line + (" " if current_line else "") + word
-            width = font.text_length(test_line, fontsize=fontsize)
-            if width <= max_width:
-                current_line = test_line
-            else:
-                if current_line:
-                    lines.append(current_line)
-                current_line = word
-        if current_line:
-            lines.append(current_line)
-
-        inserted = 0
-        for i, line in enumerate(lines):
-            y_pos = y + i * line_height
-            if y_pos + line_height > y_limit:
-                logger.warning(f"Reached y_limit={y_limit:.2f}, truncating comment")
+            if total >= budget:
                 break
-            page.insert_text(
-                (x, y_pos),
-                line,
-                fontsize=fontsize,
-                color=color,
-                fontname=fontname,
-                overlay=True,
-            )
-            inserted += 1
+            w = font.text_length(word, fontsize=fontsize) + space_w
+            widths.append(w)
+            total += w
+            budget += max(0.0, w - line_w)
+        cum = np.cumsum(widths)
+        lines = []
+        start = 0
+        while start < len(widths) and len(lines) < max_lines:
+            base = cum[start - 1] if start else 0.0
+            end = int(np.searchsorted(cum, base + max_width + space_w, side="right"))
+            end = max(end, start + 1)  # an over-wide word still gets its own line
+            lines.append(" ".join(words[start:end]))
+            start = end
+
+        if start < len(words):
+            logger.warning("Reached y_limit=%.2f, truncating comment", y_limit)
+
+        # Batch all lines into one TextWriter and write it to the page once
+        tw = fitz.TextWriter(page.rect, color=color)
+        for i, line in enumerate(lines):
+            tw.append((x, y + i * line_height), line, font=font, fontsize=fontsize)
+        if lines:
+            tw.write_text(page, overlay=True)
 
-        logger.info(f"Inserted {inserted}/{len(lines)} wrapped lines at x={x}, y_start={y}, clipped at y_limit={y_limit}")
+        logger.debug("Inserted %d wrapped lines at x=%s, y_start=%s, clipped at y_limit=%s", len(lines), x, y, y_limit)
     except Exception as e:
-        logger.error(f"Error inserting wrapped text: {e}")
+        logger.error("Error inserting wrapped text: %s", e)
 
 def insert_tick(page, x0, y0, placed_ticks):
     """Insert tick at the start of a line using the first word's y0."""
@@ -54,7 +148,8 @@ def insert_tick(page, x0, y0, placed_ticks):
         tick_key = round(tick_y, 1)
 
         if tick_key in placed_ticks:
-            logger.info(f"  Tick already present near y={tick_y}, skipping...")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("  Tick already present near y=%s, skipping...", tick_y)
             return False
 
         tw = fitz.TextWriter(page.rect)
@@ -66,44 +161,69 @@ def insert_tick(page, x0, y0, placed_ticks):
         tw.write_text(page, overlay=True)
 
         placed_ticks.add(tick_key)
-        logger.info(f"Inserted tick at ({tick_x}, {tick_y})")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Inserted tick at (%s, %s)", tick_x, tick_y)
         return True
     except Exception as e:
-        logger.error(f"Error inserting tick: {e}")
+        logger.error("Error inserting tick: %s", e)
         return False
 
-def annotate_correct_lines(doc, correct_lines):
+def flatten_entries(entries):
     """
-    Annotate correct lines with tick marks across the whole document.
-    Uses cross-page lookahead before falling back to word chunks.
-    Advances page pointer forward (never goes back).
+    Flatten the question-based stringified lists from the grades CSV into a
+    single list of non-empty strings. Entries that are not list literals are
+    kept as raw strings.
     """
-    logger.info("Starting tick annotation for entire document")
-
-    # --- Flatten the question-based stringified lists into a list of actual lines ---
-    flat_lines = []
-    for idx, entry in enumerate(correct_lines):
+    flat = []
+    for idx, entry in enumerate(entries):
+        if not isinstance(entry, str) or not entry.strip():
+            logger.info("Skipping empty or invalid entry at index %d: %s", idx, entry)
+            continue
+        entry = entry.strip()
+        if not entry.startswith('['):
+            flat.append(entry)
+            continue
         try:
             parsed = ast.literal_eval(entry)
-            if isinstance(parsed, list):
-                for ln in parsed:
-                    if isinstance(ln, str) and ln.strip():
-                        flat_lines.append(ln.strip())
-            elif isinstance(parsed, str) and parsed.strip():
-                flat_lines.append(parsed.strip())
-            else:
-                # not a list or string we can use
-                logger.info(f"Skipping invalid parsed entry at index {idx}: {entry}")
         except (ValueError, SyntaxError):
-            # If parsing fails, fall back to using the raw entry if it's a non-empty string
-            if isinstance(entry, str) and entry.strip():
-                flat_lines.append(entry.strip())
-            else:
-                logger.info(f"Failed to parse entry at index {idx}, skipping.")
+            # If parsing fails, fall back to using the raw entry
+            flat.append(entry)
+            continue
+        if not isinstance(parsed, list):
+            logger.info("Skipping invalid parsed entry at index %d: %s", idx, entry)
+            continue
+        for item in parsed:
+            if isinstance(item, str) and item.strip():
+                flat.append(item.strip())
+    return flat
+
+def build_doc_text(page_texts):
+    """
+    Concatenate cached page texts into one document-wide string (pages separated
+    by a newline, so matches never span pages) plus the start offset of each page.
+    """
+    page_offsets = []
+    pos = 0
+    for text, _, _ in page_texts:
+        page_offsets.append(pos)
+        pos += len(text) + 1
+    return "\n".join(text for text, _, _ in page_texts), page_offsets
+
+def annotate_correct_lines(doc, flat_lines, page_texts):
+    """
+    Annotate correct lines with tick marks across the whole document.
+    Scans forward through the document text from the current page (never goes
+    back) before falling back to word chunks on the current and next page.
+    """
+    logger.info("Starting tick annotation for entire document")
 
-    logger.info(f"Flattened correct_lines: {len(flat_lines)} lines (from {len(correct_lines)} entries)")
+    # Drop repeated lines (case-insensitive) while keeping their first-seen order
+    seen = set()
+    flat_lines = [ln for ln in flat_lines if not (ln.lower() in seen or seen.add(ln.lower()))]
 
+    doc_text, page_offsets = build_doc_text(page_texts)
     placed_ticks = set()
+    matched_prefixes = set()
     line_index = 0
     total_lines = len(flat_lines)
     page_num = 0  # start from first page
@@ -113,40 +233,32 @@ def annotate_correct_lines(doc, correct_lines):
         line = flat_lines[line_index]
 
         search_text = line[:50].strip()
-        if not search_text:
-            logger.info(f"Skipping empty line at index {line_index}: {line}")
+        needle = " ".join(search_text.lower().split())
+        if not needle:
+            logger.info("Skipping empty line at index %d: %s", line_index, line)
+            line_index += 1
+            continue
+
+        if needle in matched_prefixes:
+            logger.info("Line %d shares an already ticked prefix, skipping", line_index + 1)
             line_index += 1
             continue
 
         matched = False
 
-        # --- Try current page
-        page = doc[page_num]
-        instances = page.search_for(search_text, clip=page.rect)
-        if instances:
-            logger.info(f"Exact match for '{search_text}' on page {page_num+1}")
-            x0, y0, x1, y1 = instances[0]
+        # --- Exact match on the current page or any later one
+        pos = doc_text.find(needle, page_offsets[page_num])
+        if pos != -1:
+            hit_page = bisect_right(page_offsets, pos) - 1
+            start = pos - page_offsets[hit_page]
+            logger.info("Exact match for '%s' on page %d", search_text, hit_page + 1)
+            x0, y0, x1, y1 = text_range_rects(page_texts[hit_page], start, start + len(needle))[0]
             line_key = round((y0 + y1) / 2, 1)
             if line_key not in placed_ticks:
-                insert_tick(page, x0, y0, placed_ticks)
+                insert_tick(doc[hit_page], x0, y0, placed_ticks)
                 placed_ticks.add(line_key)
             matched = True
-
-        # --- Lookahead: search future pages (only if not matched on current page)
-        if not matched:
-            for next_page in range(page_num+1, len(doc)):
-                instances = doc[next_page].search_for(search_text, clip=doc[next_page].rect)
-                if instances:
-                    logger.info(f"Exact match for '{search_text}' found on future page {next_page+1}")
-                    x0, y0, x1, y1 = instances[0]
-                    line_key = round((y0 + y1) / 2, 1)
-                    if line_key not in placed_ticks:
-                        insert_tick(doc[next_page], x0, y0, placed_ticks)
-                        placed_ticks.add(line_key)
-                    matched = True
-                    page_num = next_page  # 🚀 jump forward to this page
-                    break
-
+            page_num = hit_page  # 🚀 jump forward to this page
 
         if not matched:
             for fallback_page in [page_num, page_num + 1]:
@@ -154,19 +266,19 @@ def annotate_correct_lines(doc, correct_lines):
                     continue  # no page to check
 
                 fb_page = doc[fallback_page]
-                logger.info(f"No exact match for '{search_text}', trying fallback word-by-word on page {fallback_page+1}")
+                logger.info("No exact match for '%s', trying fallback word-by-word on page %d", search_text, fallback_page + 1)
 
-                words_in_line = re.findall(r'\b\w+\b', search_text)
+                tokens = (t.strip(string.punctuation) for t in search_text.split())
+                words_in_line = [w for w in tokens if w.isalnum() and len(w) > 1]
                 word_hits = []
 
                 for word in words_in_line:
-                    instances = fb_page.search_for(word, clip=fb_page.rect)
+                    instances = search_page_text(page_texts[fallback_page], word, first_only=True)
                     if instances:
                         word_hits.append(instances[0])
 
                     if len(word_hits) >= 4:  # ✅ require at least 4 words
                         # Use the Y position of the first hit as anchor
-                        logger.info(f"Fallback word match success for '{search_text}' on page {fallback_page+1}")
                         x0, y0, x1, y1 = word_hits[0]
                         line_key = round((y0 + y1) / 2, 1)
                         if line_key not in placed_ticks:
@@ -174,74 +286,164 @@ def annotate_correct_lines(doc, correct_lines):
                             placed_ticks.add(line_key)
                         matched = True
                         page_num = fallback_page  # 🚀 update current page if fallback was on next page
-                        logger.info(f"Fallback word match success for '{search_text}' on page {fallback_page+1}")
+                        logger.info("Fallback word match success for '%s' on page %d", search_text, fallback_page + 1)
                         break
 
                 if matched:
                     break
 
+        if matched:
+            matched_prefixes.add(needle)
+
         # Move to next flat line
         line_index += 1
 
         if not matched:
-            logger.info(f"Line {line_index} not matched, moving on...")
-
-    logger.info("Completed annotation of all lines.")
-
-        # Don't auto-increment page_num unless explicitly jumped
-    logger.info(f"Completed annotation: {line_index}/{total_lines} lines processed.")
+            logger.info("Line %d not matched, moving on...", line_index)
+
+    logger.info("Completed annotation: %d/%d lines processed.", line_index, total_lines)
+
+
+def underline_correct_words(page, keyword_processor, page_num, page_text):
+    """Underline the correct words or phrases found on the page in a single keyword pass."""
+    logger.info("Starting underline annotation for page %d", page_num + 1)
+
+    matches = keyword_processor.extract_keywords(page_text[0], span_info=True)
+    logger.info("Found %d correct word matches on page %d", len(matches), page_num + 1)
+
+    for search_text, start, end in matches:
+        for inst in text_range_rects(page_text, start, end):
+            try:
+                x0, y0, x1, y1 = inst
+                underline_y = y1 + 2
+                page.draw_line(
+                    (x0, underline_y),
+                    (x1, underline_y),
+                    color=(1, 0, 0),
+                    width=1.5,
+                    overlay=True
+                )
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("Underlined '%s' at (%s, %s) to (%s, %s) on page %d.", search_text, x0, underline_y, x1, underline_y, page_num)
+            except Exception as e:
+                logger.error("Error underlining '%s': %s", search_text, e)
+
+    logger.info("Completed underline annotation for page %d", page_num + 1)
+
+def read_page(page):
+    """
+    Extract a page once, as rawdict, and derive everything annotation needs from it.
+    Returns (page_text, line_texts, question_positions): page_text is the
+    build_page_text word index, line_texts holds the text of each line and
+    question_positions one (question_number, rect, line_index) per match, with the
+    rect built from the number's own characters (so numbers that start mid-span,
+    straddle two spans or repeat on the page are each placed exactly).
+    Must run before any annotation text is added to the page.
+    """
+    words = []
+    line_texts = []
+    question_positions = []
+    # Images are not needed, so skip decoding them into the dict
+    blocks = page.get_text("rawdict", flags=fitz.TEXTFLAGS_RAWDICT & ~fitz.TEXT_PRESERVE_IMAGES)["blocks"]
+    for block_no, block in enumerate(blocks):
+        for line_no, line in enumerate(block.get("lines", [])):
+            chars = [char for span in line.get("spans", []) for char in span.get("chars", [])]
+            line_text = "".join(char["c"] for char in chars)
+            # Words are the whitespace-separated runs of characters, as in get_text("words")
+            for is_space, run in groupby(chars, key=lambda char: char["c"].isspace()):
+                if not is_space:
+                    run = list(run)
+                    rect = fitz.Rect(run[0]["bbox"])
+                    for char in run[1:]:
+                        rect |= char["bbox"]
+                    words.append((*rect, "".join(char["c"] for char in run), block_no, line_no, len(words)))
+            for m in _QUESTION_RE.finditer(line_text):
+                rect = fitz.Rect(chars[m.start()]["bbox"]) | fitz.Rect(chars[m.end() - 1]["bbox"])
+                question_positions.append((m.group(0), rect, len(line_texts)))
+            line_texts.append(line_text)
+    return build_page_text(words), line_texts, question_positions
+
+def annotate_page(page, page_num, score_dict, comment_dict, keyword_processor, page_layout):
+    """
+    Annotate a single page with scores, comments and underlines (page-local work
+    only). `page_layout` is the page's read_page result, taken before annotating.
+    """
+    logger.info("Processing page %d", page_num + 1)
 
+    page_text, line_texts, question_positions = page_layout
+    if logger.isEnabledFor(logging.INFO):
+        for q_num, rect, _ in question_positions:
+            logger.info("Matched %s at y=%.2f", q_num, rect.y0)
+    logger.info("Found %d potential question matches", len(question_positions))
 
-def underline_correct_words(page, correct_words, page_num):
-    """Underline specific words or phrases from the correct_words list."""
-    logger.info(f"Starting underline annotation for page {page_num + 1}")
+    question_positions = sorted(question_positions, key=lambda x: x[1].y0)
     
-    for word_entry in correct_words:
-        try:
-            parsed_words = ast.literal_eval(word_entry)
-            if not isinstance(parsed_words, list):
-                logger.info(f"Skipping invalid word data: {word_entry}")
-                continue
-        except (ValueError, SyntaxError):
-            logger.warning(f"Failed to parse word data: {word_entry}, skipping.")
-            continue
+    annotated_questions = set()
+    
+    for i, (q_num, inst, line_idx) in enumerate(question_positions):
+        y0 = inst.y0
+        y1 = (question_positions[i+1][1].y0
+              if i+1 < len(question_positions) else page.rect.height)
         
-        for correct_word in parsed_words:
-            search_text = correct_word.strip()
-            if not search_text:
-                logger.info(f"Skipping empty correct word: '{correct_word}'")
-                continue
-            
-            word_instances = page.search_for(search_text, clip=page.rect)
-            
-            if not word_instances:
-                logger.info(f"No exact match for phrase: '{search_text}' on page {page_num}.")
+        surrounding_text = line_texts[line_idx].strip()
+        logger.info("Surrounding text on same line: '%s'", surrounding_text)
+        
+        if _SCORE_KW_RE.search(surrounding_text):
+            logger.info("Skipping %s as it appears to be a score", q_num)
+        else:
+            if q_num in score_dict and q_num not in annotated_questions:
+                logger.info("Annotating %s with score %s", q_num, score_dict[q_num])
+                x_offset = -40
+                text_x = inst.x0 + x_offset
+                text_y = inst.y0 + 10
+                
+                score_text = score_dict[q_num]
+                page.insert_text(
+                    (text_x, text_y),
+                    score_text,
+                    fontsize=12,
+                    color=(0, 0, 1)
+                )
+
+                annotated_questions.add(q_num)
+                logger.info("Successfully annotated %s on page %d", q_num, page_num + 1)
             else:
-                logger.info(f"Found exact match for '{search_text}' ({len(word_instances)} instances).")
-                for inst in word_instances:
-                    try:
-                        x0, y0, x1, y1 = inst
-                        underline_y = y1 + 2
-                        page.draw_line(
-                            (x0, underline_y),
-                            (x1, underline_y),
-                            color=(1, 0, 0),
-                            width=1.5,
-                            overlay=True
-                        )
-                        logger.info(f"Underlined '{search_text}' at ({x0}, {underline_y}) to ({x1}, {underline_y}) on page {page_num}.")
-                    except Exception as e:
-                        logger.error(f"Error underlining '{search_text}': {e}")
-
-    logger.info(f"Completed underline annotation for page {page_num + 1}")
-
-def annotate_pdf(input_dir, output_dir, student_name, grades_csv_path):
-    """Annotate PDF with scores, comments, ticks, and underlines."""
+                logger.info("Question %s not in grades or already annotated", q_num)
+        
+        if q_num in comment_dict:
+            comment = comment_dict[q_num]
+            logger.info("Annotating %s between y=%.2f and y=%.2f with comment: %s", q_num, y0, y1, comment)
+            x_left = page.rect.width - 90
+            max_width = 90
+            insert_wrapped_text(
+                page,
+                x_left,
+                y0,
+                comment,
+                max_width=max_width,
+                fontsize=8,
+                color=(1, 0, 0),
+                fontname="helv",
+                y_limit=y1 - 5
+            )
+
+    if keyword_processor:
+        underline_correct_words(page, keyword_processor, page_num, page_text)
+
+def annotate_pdf(input_dir, output_dir, student_name, grades_csv_path, output_pdf_path=None):
+    """
+    Annotate PDF with scores, comments, ticks, and underlines. Callers that already
+    know the destination pass output_pdf_path and must have created its directory;
+    otherwise it is derived from output_dir and student_name.
+    """
     # input_pdf_path = os.path.join(input_dir, f"{student_name}.pdf")
     input_pdf_path = input_dir
 
-    student_lower = student_name.lower()
-    output_pdf_path = os.path.join(output_dir, student_lower, f"{student_lower}_annotated.pdf")
+    if output_pdf_path is None:
+        student_lower = student_name.lower()
+        student_dir = os.path.join(output_dir, student_lower)
+        os.makedirs(student_dir, exist_ok=True)
+        output_pdf_path = os.path.join(student_dir, f"{student_lower}_annotated.pdf")
     
     logger.info(f"Starting annotation process for {input_pdf_path}")
     
@@ -264,9 +466,11 @@ def annotate_pdf(input_dir, output_dir, student_name, grades_csv_path):
         logger.error(f"Error loading CSV: {e}")
         return False
 
-    correct_lines = grades_df['correct_lines'].dropna().tolist()
-    correct_words = grades_df['correct_words'].dropna().tolist()
+    # Parse the stringified lists once, outside any page iteration
+    correct_lines = flatten_entries(grades_df['correct_lines'].dropna().tolist())
+    correct_words = flatten_entries(grades_df['correct_words'].dropna().tolist())
     logger.info(f"Loaded {len(correct_lines)} correct lines and {len(correct_words)} correct words from CSV")
+    keyword_processor = build_keyword_processor(correct_words) if correct_words else None
     
     try:
         logger.info(f"Opening PDF: {input_pdf_path}")
@@ -277,112 +481,31 @@ def annotate_pdf(input_dir, output_dir, student_name, grades_csv_path):
         return False
     
     try:
+        # Extract each page once, before any annotation text is added
+        page_layouts = [read_page(page) for page in doc]
+        page_texts = [layout[0] for layout in page_layouts]
+
         logger.info("Creating score dictionary from grades")
-        score_dict = {str(row['question_number']): f"{row['score']}/{row['total_marks']}" for _, row in grades_df.iterrows()}
+        question_numbers = grades_df['question_number'].astype(str)
+        score_dict = dict(zip(
+            question_numbers,
+            grades_df['score'].astype(str) + '/' + grades_df['total_marks'].astype(str)
+        ))
         logger.info(f"Score dictionary created with {len(score_dict)} entries")
+
+        comments = grades_df['comment'].fillna('') if 'comment' in grades_df else pd.Series([''] * len(grades_df))
+        comment_dict = dict(zip(question_numbers, comments))
         
-        comment_dict = {str(row['question_number']): row.get('comment', '') for _, row in grades_df.iterrows()}
-        
+        # PyMuPDF does not support multithreading, so pages are annotated sequentially
         for page_num in range(len(doc)):
-            logger.info(f"Processing page {page_num + 1}")
-            page = doc[page_num]
-            
-            logger.info("Extracting text from page")
-            text_on_page = page.get_text("text")
-            logger.info(f"Extracted {len(text_on_page)} characters of text")
-            
-            text_blocks = page.get_text("dict")["blocks"]
-            
-            logger.info("Searching for question numbers")
-            question_pattern = r'(?<!\d)\d+\.\d+(?:\([a-z]\))?(?!\d)'
-            question_matches = list(re.finditer(question_pattern, text_on_page))
-            logger.info(f"Found {len(question_matches)} potential question matches")
-            
-            question_positions = []
-            for m in question_matches:
-                q_num = m.group(0)
-                rects = page.search_for(q_num)
-                if rects:
-                    y0 = rects[0].y0
-                    start_pos = m.start()
-                    question_positions.append((q_num, y0, start_pos))
-                    logger.info(f"Matched {q_num} at y={y0:.2f}")
-            
-            question_positions.sort(key=lambda x: x[1])
-            
-            annotated_questions = set()
-            
-            for i, (q_num, y0, start_pos) in enumerate(question_positions):
-                y1 = (question_positions[i+1][1] 
-                      if i+1 < len(question_positions) else page.rect.height)
-                
-                line_start = text_on_page.rfind('\n', 0, start_pos) + 1
-                line_end = text_on_page.find('\n', start_pos)
-                if line_end == -1:
-                    line_end = len(text_on_page)
-                surrounding_text = text_on_page[line_start:line_end].strip()
-                logger.info(f"Surrounding text on same line: '{surrounding_text}'")
-                
-                if any(keyword in surrounding_text.lower() for keyword in ['marks', '/', 'score', 'total']):
-                    logger.info(f"Skipping {q_num} as it appears to be a score")
-                else:
-                    if q_num in score_dict and q_num not in annotated_questions:
-                        logger.info(f"Annotating {q_num} with score {score_dict[q_num]}")
-                        text_instances = page.search_for(q_num)
-                        if text_instances:
-                            inst = text_instances[0]
-                            
-                            x_offset = -40
-                            text_x = inst.x0 + x_offset
-                            text_y = inst.y0 + 10
-                            
-                            score_text = score_dict[q_num]
-                            page.insert_text(
-                                (text_x, text_y),
-                                score_text,
-                                fontsize=12,
-                                color=(0, 0, 1)
-                            )
-                            
-                            tw = fitz.TextWriter(page.rect)
-                            tw.append((text_x, text_y), score_text)
-                            text_rect = tw.rect
-                            tw = None
-                            
-                            annotated_questions.add(q_num)
-                            logger.info(f"Successfully annotated {q_num} on page {page_num + 1}")
-                        else:
-                            logger.warning(f"Could not find position for {q_num} on page {page_num + 1}")
-                    else:
-                        logger.info(f"Question {q_num} not in grades or already annotated")
-                
-                if q_num in comment_dict:
-                    comment = comment_dict[q_num]
-                    logger.info(f"Annotating {q_num} between y={y0:.2f} and y={y1:.2f} with comment: {comment}")
-                    x_left = page.rect.width - 90
-                    max_width = 90
-                    insert_wrapped_text(
-                        page,
-                        x_left,
-                        y0,
-                        comment,
-                        max_width=max_width,
-                        fontsize=8,
-                        color=(1, 0, 0),
-                        fontname="helv",
-                        y_limit=y1 - 5
-                    )
-            
-            
-            if correct_words:
-                underline_correct_words(page, correct_words, page_num)
-        
+            annotate_page(doc[page_num], page_num, score_dict, comment_dict, keyword_processor, page_layouts[page_num])
+
         if correct_lines:
-                annotate_correct_lines(doc, correct_lines)
+                annotate_correct_lines(doc, correct_lines, page_texts)
 
         logger.info(f"Saving annotated PDF to {output_pdf_path}")
-        os.makedirs(os.path.dirname(output_pdf_path), exist_ok=True)
-        doc.save(output_pdf_path)
+        # Output is always a new file, so a full (non-incremental) compacted save is used
+        doc.save(output_pdf_path, garbage=3, deflate=True, deflate_images=False, clean=True)
         logger.info(f"Annotation process completed. Saved as {output_pdf_path}")
         return True
     except Exception as e:
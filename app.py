@@ -1,15 +1,26 @@
 import streamlit as st
 import os
+import shutil
 import tempfile
 from dummy_main import extract_question_and_model_answer, grade_and_annotate_student  # Direct import!
+from logging_config import configure_logging
 import traceback
 
+configure_logging()
+
+def get_temp_dir():
+    """Create this session's upload temp directory once instead of on every Streamlit rerun."""
+    if "temp_dir" not in st.session_state:
+        st.session_state.temp_dir = tempfile.mkdtemp(prefix="exam_grader_")
+    return st.session_state.temp_dir
+
 def save_uploaded_file(uploaded_file, temp_dir):
     """Save uploaded file to temp directory."""
     os.makedirs(temp_dir, exist_ok=True)
     file_path = os.path.join(temp_dir, uploaded_file.name)
+    uploaded_file.seek(0)
     with open(file_path, "wb") as f:
-        f.write(uploaded_file.getbuffer())
+        shutil.copyfileobj(uploaded_file, f, length=1 << 20)
     return file_path
 
 def parse_pages(page_str):
@@ -23,7 +34,7 @@ def main():
     st.title("📚 Automated Exam Grader")
     
     # Temp directory for uploaded files
-    temp_dir = tempfile.mkdtemp(prefix="exam_grader_")
+    temp_dir = get_temp_dir()
     
     # File uploads
     st.header("📁 Upload PDFs")
@@ -58,11 +69,11 @@ def main():
     if st.checkbox("🐛 Show Debug Info"):
         st.write("**Uploaded Files:**")
         if question_pdf:
-            st.write(f"- Question: {question_pdf.name} ({len(question_pdf.getbuffer()):,} bytes)")
+            st.write(f"- Question: {question_pdf.name} ({question_pdf.size:,} bytes)")
         if model_answer_pdf:
-            st.write(f"- Model: {model_answer_pdf.name} ({len(model_answer_pdf.getbuffer()):,} bytes)")
+            st.write(f"- Model: {model_answer_pdf.name} ({model_answer_pdf.size:,} bytes)")
         if student_pdf:
-            st.write(f"- Student: {student_pdf.name} ({len(student_pdf.getbuffer()):,} bytes)")
+            st.write(f"- Student: {student_pdf.name} ({student_pdf.size:,} bytes)")
         
         st.write("**Parsed Pages:**")
         st.write(f"- Question pages: {question_pages}")
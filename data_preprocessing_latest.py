@@ -1,35 +1,20 @@
 import fitz  
 import os
-import json
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 from pathlib import Path
-from langchain_groq import ChatGroq
-from dotenv import load_dotenv
+from itertools import groupby
+from functools import lru_cache
 from langchain.prompts import PromptTemplate
 from langchain.output_parsers import PydanticOutputParser
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import List
 from logging_config import logger
-from llm_setup import llm
+from pdf_lock import PDF_LOCK
+from schemas import ModelAnswerExtraction, QuestionExtraction
+from llm_setup import get_llm
 from datetime import datetime
 
 
-class SubAnswer(BaseModel):
-    question_number: str = Field(description="Subquestion number like '1.1' or 'a)'")
-    answer: Optional[str] = Field(description="The model answer content if available for that section; omit if the content belongs to its sub-sections")
-    marking_criteria: Optional[str] = Field(None, description="Marking criteria details if available; omit if it belongs to sub sections")
-    total_marks_available: Optional[str] = Field(None, description="Total marks available for this part; omit if belong to subsections")
-    maximum_marks: Optional[str] = Field(None, description="Maximum full marks (if stated); omit if belong to sub sections")
-    sub_answers: Optional[List["SubAnswer"]] = Field(
-        None,
-        description="Nested sub-answers if the subquestion has further divisions like a), b), etc."
-    )
-
-class ModelAnswerExtraction(BaseModel):
-    question_title: str = Field(description="Main question title, e.g., 'Question 1'")
-    description: Optional[str] = Field(None, description="Introductory paragraph or assumption if given")
-    answers: List[SubAnswer] = Field(..., description="List of main answers or sub-sections like 1.1, 1.2, etc.")
-    total_marks: Optional[str] = Field(None, description="Total marks for this main question if mentioned")
-
 prompt_template = """
 You are an expert in extracting and structuring model answers from exam marking guides.
 
@@ -71,20 +56,11 @@ prompt_model_answer = PromptTemplate(
 )
 
 # Create the LLM chain for model answer extraction
-chain_model_answer = prompt_model_answer | llm  | parser
+@lru_cache(maxsize=None)
+def get_chain_model_answer():
+    return prompt_model_answer | get_llm() | parser
 
 # Keep question extraction chain for reference (from previous code)
-class SubQuestion(BaseModel):
-    question_number: str = Field(description="Subquestion number like '1.1' or 'a)'")
-    content: str = Field(description="Full content of the subquestion")
-    marks: Optional[str] = Field(None, description="Marks for this subquestion, e.g., '5 marks'")
-
-class QuestionExtraction(BaseModel):
-    question_title: str = Field(description="Main question title (e.g., 'Question 1')")
-    description: Optional[str] = Field(None, description="Introductory description or assumptions")
-    questions: List[SubQuestion] = Field(..., description="List of subquestions or single main question")
-    total_marks: Optional[str] = Field(None, description="Total marks for this main question")
-
 question_parser = PydanticOutputParser(pydantic_object=QuestionExtraction)
 
 question_prompt = PromptTemplate(
@@ -132,25 +108,37 @@ The goal is to accurately identify:
     partial_variables={"format_instructions": question_parser.get_format_instructions()}
 )
 
-chain_question = question_prompt | llm | question_parser
+@lru_cache(maxsize=None)
+def get_chain_question():
+    return question_prompt | get_llm() | question_parser
 
 def extract_text_from_pdf_pages(pdf_path: str, page_numbers: List[int]) -> str:
     """Extract text from specified PDF pages."""
     if not os.path.exists(pdf_path):
         raise FileNotFoundError(f"PDF file not found: {pdf_path}")
     
-    doc = fitz.open(pdf_path)
-    text = ""
-    
-    for page_num in sorted(page_numbers):
-        if page_num > len(doc):
-            raise ValueError(f"Page {page_num} does not exist in PDF")
-        page = doc.load_page(page_num - 1)  # 0-indexed
-        page_text = page.get_text()
-        text += f"\n--- Page {page_num} ---\n{page_text}\n\n"
-    
-    doc.close()
-    return text.strip()
+    parts = []
+    with PDF_LOCK:
+        doc = fitz.open(pdf_path)
+        try:
+            page_numbers = sorted(page_numbers)
+            for page_num in page_numbers:
+                if page_num > len(doc):
+                    raise ValueError(f"Page {page_num} does not exist in PDF")
+            # Walk contiguous runs (e.g. 3,4,5) with doc.pages() so MuPDF reads them in sequence;
+            # isolated pages are loaded directly
+            for _, run in groupby(enumerate(page_numbers), key=lambda item: item[1] - item[0]):
+                run = [page_num for _, page_num in run]
+                if len(run) > 1 and run[0] >= 1:
+                    pages = doc.pages(run[0] - 1, run[-1])
+                else:
+                    pages = (doc.load_page(page_num - 1) for page_num in run)  # 0-indexed
+                for page_num, page in zip(run, pages):
+                    page_text = page.get_text()
+                    parts.append(f"\n--- Page {page_num} ---\n{page_text}\n\n")
+        finally:
+            doc.close()
+    return "".join(parts).strip()
 
 def extract_single_model_answer(pdf_path: str, page_numbers: List[int], question_num: str) -> ModelAnswerExtraction:
     """
@@ -171,7 +159,7 @@ def extract_single_model_answer(pdf_path: str, page_numbers: List[int], question
         raise ValueError(f"No text found on specified pages for question {question_num}")
     
     # Use the model answer chain to extract
-    result = chain_model_answer.invoke({
+    result = get_chain_model_answer().invoke({
         "answer_text": pdf_text,
         "question_num": question_num
     })
@@ -184,12 +172,30 @@ def extract_single_question(pdf_path: str, page_numbers: List[int], question_num
     if not pdf_text.strip():
         raise ValueError(f"No text found for question {question_num}")
     
-    result = chain_question.invoke({
+    result = get_chain_question().invoke({
         "answer_text": pdf_text,
         "question_num": question_num
     })
     return result
 
+def extract_question_and_model_answer_data(
+    question_pdf_path: str,
+    question_pages: List[int],
+    model_answer_pdf_path: str,
+    answer_pages: List[int],
+    question_num: str
+) -> tuple[QuestionExtraction, ModelAnswerExtraction]:
+    """
+    Run the question and model answer extractions concurrently on two threads; they
+    are independent LLM calls, so wall time is the slower of the two, not their sum.
+    Threads rather than an event loop keep the shared sync client usable from any
+    caller, including ones that already run a loop.
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        question_future = executor.submit(extract_single_question, question_pdf_path, question_pages, question_num)
+        model_answer_future = executor.submit(extract_single_model_answer, model_answer_pdf_path, answer_pages, question_num)
+        return question_future.result(), model_answer_future.result()
+
 def save_extracted_data(data: object, output_path: str):
     """
     Generic save function for any Pydantic model data.
@@ -199,8 +205,10 @@ def save_extracted_data(data: object, output_path: str):
         output_path: Path to save the JSON file
     """
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(data.model_dump(exclude_unset=True), f, indent=2, ensure_ascii=False)
+    # orjson writes UTF-8 without escaping non-ASCII, like ensure_ascii=False
+    Path(output_path).write_bytes(
+        orjson.dumps(data.model_dump(exclude_unset=True), option=orjson.OPT_INDENT_2)
+    )
     logger.info(f"Saved data to {output_path}")
 
 def extract_and_save_question_answer(
@@ -219,8 +227,11 @@ def extract_and_save_question_answer(
     """
     try:
         # Extract data
-        question_data = extract_single_question(question_pdf_path, question_pages, question_num)
-        model_answer_data = extract_single_model_answer(model_answer_pdf_path, answer_pages, question_num)
+        question_data, model_answer_data = extract_question_and_model_answer_data(
+            question_pdf_path, question_pages,
+            model_answer_pdf_path, answer_pages,
+            question_num
+        )
         
         # Generate timestamp and paths
         timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
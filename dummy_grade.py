@@ -1,79 +1,99 @@
 from langchain.prompts import ChatPromptTemplate
 from langchain.output_parsers import PydanticOutputParser
-from pydantic import BaseModel, Field
 from typing import List
 from typing import Dict
+from functools import lru_cache
+from itertools import groupby
 from langchain.prompts import PromptTemplate
-import json
-import fitz
+from langchain_core.messages import convert_to_openai_messages
+import orjson
 import re
-import pandas as pd
+import csv
 import os
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+from pathlib import Path
 from logging_config import logger
-from llm_setup import llm, llm_grader
-
-
-# Pydantic Schemas
-class SubPart(BaseModel):
-    question_number: str = Field(description="The identifier of the subsection or scenario (e.g., '1.1' or 'a)')")
-    answer: str = Field(description="content paragraphs from the student's answer for marking criteria")
-
-class QuestionExtraction(BaseModel):
-    question: str = Field(description="The main question number (e.g., '1' or '4')")
-    sub_parts: List[SubPart] = Field(description="List of subsections with their content, only if subsections like 1.1, a), A) are present")
-
-class MappingItem(BaseModel):
-    chunk_id: int = Field(..., description="Identifier of the student answer chunk.")
-    mapped_question_number: str = Field(..., description="The matched question number, e.g., '1.1', or '0' if unmapped.")
-
-class MappingList(BaseModel):
-    mappings: List[MappingItem]
-
-class GradingItem(BaseModel):
-    question_number: str = Field(..., description="The number of the question/sub-question, e.g., '1.1'.")
-    score: str = Field(..., description="Marks obtained by the student, e.g., '3'.")
-    total_marks: str = Field(..., description="Total marks for the question, e.g., '5', from maximum_marks, only include integer value nothing else like marks and other words.")
-    comment: str = Field(..., description="Feedback comment for the student, Should be concise but covering what went wrong and to the point, should not exceed three lines")
-    correct_lines: List[str] = Field(..., description="Exact lines from the student's answer that are deemed correct, should be exact matching with same wording and everything")
-    correct_words: List[str] = Field(..., description="Exact words from the student's answer explaining why the lines are correct.")
-
-class GradingList(BaseModel):
-    grades: List[GradingItem]
+from pdf_lock import PDF_LOCK
+from schemas import StudentAnswerExtraction, MappingList, GradingList, BatchGradingList
+from llm_setup import get_llm, get_llm_grader, retry_grader_batch_as_completed, retry_grader_invoke, submit_grading_batch
+
+# Page header ("3 /12") and spreadsheet boilerplate stripped from extracted answer text
+_HEADER_RE = re.compile(r"^\d+ /\d+\s*", re.MULTILINE)
+_WP_RE = re.compile(r"Word Processing area.*?- use the shortcut keys to copy from the spreadsheet\s*")
+# Whole subsection label such as "1.1", "2", "a)", "(b)" or "(iv)"; group 1 is numeric, group 2 a letter/roman tag
+_SUBSEC_RE = re.compile(r"\s*(?:(\d+(?:\.\d+)*)\.?|\(?([a-zA-Z]|[ivxIVX]+)\))\s*")
+
+# Students per batched grading call, and the rough prompt size (tokens) above
+# which a batch is split back into per-student calls
+GRADING_BATCH_SIZE = int(os.getenv("GRADING_BATCH_SIZE", "5"))
+MAX_BATCH_PROMPT_TOKENS = int(os.getenv("MAX_BATCH_PROMPT_TOKENS", "24000"))
+# The grader (gpt-oss) reasons before it answers, and those tokens count against max_tokens
+GRADER_REASONING_TOKENS = int(os.getenv("GRADER_REASONING_TOKENS", "2048"))
+# Output for one graded item (comment, correct_lines, correct_words); one is written per model answer question
+GRADER_TOKENS_PER_QUESTION = int(os.getenv("GRADER_TOKENS_PER_QUESTION", "256"))
+# Upper bound on grading output tokens per student
+GRADER_MAX_TOKENS_CAP = int(os.getenv("GRADER_MAX_TOKENS_CAP", "16384"))
+
+
+@lru_cache(maxsize=32)
+def _load_json_cached(questions_path, model_answers_path, questions_mtime, model_answers_mtime):
+    """
+    Parse both JSON files and serialize them once for the prompts; the mtimes are
+    part of the cache key so edited files are re-read.
+    """
+    questions = orjson.loads(Path(questions_path).read_bytes())['questions']
+    model_data = orjson.loads(Path(model_answers_path).read_bytes())['answers']
+    return questions, model_data, orjson.dumps(questions).decode(), orjson.dumps(model_data).decode()
 
+def load_prompt_payloads(questions_path, model_answers_path):
+    """
+    Load questions and model answers from JSON files together with their compact JSON
+    strings for the prompts. Everything is cached across students, so callers must
+    treat the returned lists as read-only.
 
-def load_json_data(questions_path, model_answers_path):
-    """Load questions and model answers from JSON files."""
+    Returns:
+        Tuple: (questions, model_data, questions_json, model_json)
+    """
     try:
-        with open(questions_path, 'r') as f:
-            questions = json.load(f)['questions']
-        with open(model_answers_path, 'r') as f:
-            model_data = json.load(f)['answers']
+        payloads = _load_json_cached(
+            questions_path, model_answers_path,
+            os.path.getmtime(questions_path), os.path.getmtime(model_answers_path)
+        )
         logger.info(f"Loaded questions from {questions_path} and model answers from {model_answers_path}")
-        return questions, model_data
+        return payloads
     except Exception as e:
         logger.error(f"Error loading JSON data: {e}")
         raise
 
-def extract_page_text(pdf_path: str, page_num: int) -> str:
+def extract_page_text(page) -> str:
     """
-    Extracts text from a specific page of the PDF using PyMuPDF.
+    Extracts text from an already loaded PyMuPDF page.
     """
     try:
-        doc = fitz.open(pdf_path)
-        if page_num < 0 or page_num >= len(doc):
-            return ""
-        page = doc.load_page(page_num)
         text = page.get_text("text")
-        doc.close()
         # Clean the text to remove headers and extra formatting
-        text = re.sub(r"^\d+ /\d+\s*", "", text, flags=re.MULTILINE)
-        text = re.sub(r"Word Processing area.*?- use the shortcut keys to copy from the spreadsheet\s*", "", text)
+        text = _HEADER_RE.sub("", text)
+        text = _WP_RE.sub("", text)
         return text.strip()
     except Exception as e:
-        print(f"Error extracting text from page {page_num}: {e}")
+        print(f"Error extracting text from page {page.number + 1}: {e}")
         return ""
 
+def iter_pages(doc, page_nums: List[int]):
+    """
+    Yield (page_num, page) for the 1-indexed page_nums in the given order, skipping
+    pages outside the document. Contiguous runs (e.g. 3,4,5) are read through
+    doc.pages() so MuPDF walks them in sequence; isolated pages use load_page.
+    """
+    valid = [p for p in page_nums if 1 <= p <= len(doc)]
+    for _, run in groupby(enumerate(valid), key=lambda item: item[1] - item[0]):
+        run = [p for _, p in run]
+        if len(run) > 1:
+            yield from zip(run, doc.pages(run[0] - 1, run[-1]))
+        else:
+            yield run[0], doc.load_page(run[0] - 1)
+
 def extract_answers(pdf_path: str, question_num: str, page_nums: List[int]) -> Dict:
     """
     Extracts and processes the answer for a given question by:
@@ -91,20 +111,24 @@ def extract_answers(pdf_path: str, question_num: str, page_nums: List[int]) -> D
     """
     try:
         # --- Step 1: Extract and combine text from relevant pages ---
-        texts = []
-        for p in page_nums:
-            text = extract_page_text(pdf_path, p - 1)  # Assuming extract_page_text handles 0-indexing
-            if text:
-                texts.append(f"--- Page {p} ---\n{text.strip()}")
-        
-        answer_text = "\n\n".join(texts)
+        # Open the PDF once for all pages and join the pages as they are extracted
+        import fitz  # deferred so importing the grader does not pay PyMuPDF's load time
+        with PDF_LOCK:
+            doc = fitz.open(pdf_path)
+            try:
+                page_texts = ((p, extract_page_text(page)) for p, page in iter_pages(doc, page_nums))
+                answer_text = "\n\n".join(
+                    f"--- Page {p} ---\n{text}" for p, text in page_texts if text
+                )
+            finally:
+                doc.close()
 
         # --- Step 2: Handle case where no content is found ---
         if not answer_text.strip():
             return {"error": f"No content found for question {question_num} on pages {page_nums}"}
 
         # --- Step 3: Run the LLM chain for structured extraction ---
-        response = chain_answer.invoke({
+        response = get_chain_answer().invoke({
             "answer_text": answer_text,
             "question_num": question_num
         })
@@ -139,22 +163,18 @@ Instructions:
 - Do not add or change information; extract and structure what's present.
 - Alwasy remeber that only create subsections if student has specified the subsections else keep the content as a single question answer.
 - Output strictly in the specified JSON format.
-
-{format_instructions}
 """
 
-# Parser for the output
-parser = PydanticOutputParser(pydantic_object=QuestionExtraction)
-
-# Create the prompt with format instructions
 prompt = PromptTemplate(
     template=prompt_template,
-    input_variables=["answer_text", "question_num"],
-    partial_variables={"format_instructions": parser.get_format_instructions()}
+    input_variables=["answer_text", "question_num"]
 )
 
-# Create the LLM chain for answer extraction
-chain_answer = prompt | llm | parser
+# Create the LLM chain for answer extraction; the schema is sent with the
+# request as a tool definition, so it no longer has to be spelled out in the prompt
+@lru_cache(maxsize=None)
+def get_chain_answer():
+    return prompt | get_llm().with_structured_output(StudentAnswerExtraction, method="function_calling")
 
 
 map_to_questions_prompt = ChatPromptTemplate.from_template(
@@ -182,15 +202,13 @@ Now produce the mappings:
 )
 
 
-map_chain = map_to_questions_prompt | llm
+@lru_cache(maxsize=None)
+def get_map_chain():
+    return map_to_questions_prompt | get_llm()
 
-grade_parser = PydanticOutputParser(pydantic_object=GradingList)
 
-
-grade_prompt = ChatPromptTemplate.from_template(
-    """
-    You are a professional teacher who grades student answers fairly and accurately against model answers, balancing strictness with reasonable evaluation.
-    Given mappings: {mappings}\nModel answers: {model_data}\nStudent answers: {chunks}\nQuestions: {questions}\n
+# Grading rubric shared by the single-student and batched grading prompts
+GRADING_INSTRUCTIONS = """
     For each question in the model answers, compare the student's answer to the model answers with a focus on content accuracy, wording and semantic meaning.
 
     Award full marks only if all key points are fully and accurately covered; partial answers earn proportional marks according to the given criteria in model data based on the number of correctly and completely addressed points. Accept semantically equivalent phrasing if all details match, but penalize omissions or incomplete ideas. Always assign marks in 0.5 or full number no in between in the fractions.
@@ -202,135 +220,430 @@ grade_prompt = ChatPromptTemplate.from_template(
     correct_words: 2-6 word phrases extracted directly from the correct_lines, in their exact original order, that capture the core reason for correctness (focus on key terms, facts, or phrases). Use full lines only if the essence can't be captured shorter; phrases must appear verbatim as in the student's text.
     Add a concise comment: Summarize what was correct (for appreciation if any), exactly what was missing or wrong (be specific to key points omitted), and brief advice. Limit to three lines maximum; cover all aspects for the student to understand the score without fluff.
     If no student text matches a question (unmapped, missing, or empty in chunks/mappings), strictly score '0', provide feedback explaining what the student should have done, referencing key elements from the model answer to guide improvement. Do not copy or borrow from model answers under any circumstances—treat as absent.
+"""
 
-    ### Output Format
-    Return **only** a single valid JSON object in the following structure (no extra text, no markdown, no explanations):
-
-    {{
-  "grades": [
-    {{
+GRADE_ITEM_FORMAT = """{{
       "question_number": keep the question number as it is given,
       "score": Integer or float value as score that student got,
       "total_marks": Max marks from model answers don't include key like marks and other only integer value,
       "comment": "string", 
       "correct_lines": ["string", "string"],
       "correct_words": ["string", "string"]
+    }}"""
+
+# Prompt order runs from most to least shared so providers can cache the longest prefix:
+# instructions and output format (identical for every exam), then the questions and
+# model answers (identical for every student of a session), and finally the human
+# message with the student's mappings and answers, the only part that changes per call.
+grade_prompt = ChatPromptTemplate.from_messages([
+    ("system", """
+    You are a professional teacher who grades student answers fairly and accurately against model answers, balancing strictness with reasonable evaluation.
+""" + GRADING_INSTRUCTIONS + """
+    ### Output Format
+    Return **only** a single valid JSON object in the following structure (no extra text, no markdown, no explanations):
+
+    {{
+  "grades": [
+    """ + GRADE_ITEM_FORMAT + """
+  ]
+}}
+
+    Questions: {questions}\nModel answers: {model_data}\n
+"""),
+    ("human", "Given mappings: {mappings}\nStudent answers: {chunks}\n"),
+])
+
+def grader_max_tokens(student_text_len, question_count, students=1):
+    """
+    Output budget for a grading call: reasoning headroom and one graded item per model
+    answer question for each student, plus room to quote the student text back
+    (~3 chars per token, 4x) instead of a worst-case reservation. Rounded up to 512
+    so only a few chain variants exist; capped per student.
+    """
+    per_student = GRADER_REASONING_TOKENS + question_count * GRADER_TOKENS_PER_QUESTION
+    budget = students * per_student + 4 * (student_text_len // 3) + 512
+    budget = -(-budget // 512) * 512
+    return min(GRADER_MAX_TOKENS_CAP * students, budget)
+
+def _grader_with_budget(max_tokens):
+    return get_llm_grader().model_copy(update={"max_tokens": max_tokens})
+
+# JSON mode makes the provider return a bare JSON object, parsed straight into GradingList
+@lru_cache(maxsize=None)
+def get_grade_chain(max_tokens):
+    return grade_prompt | _grader_with_budget(max_tokens).with_structured_output(GradingList, method="json_mode")
+
+batch_grade_prompt = ChatPromptTemplate.from_messages([
+    ("system", """
+    You are a professional teacher who grades student answers fairly and accurately against model answers, balancing strictness with reasonable evaluation.
+    You are grading several students at once. Grade every student independently; never let one student's answer influence another's grade.
+""" + GRADING_INSTRUCTIONS + """
+    ### Output Format
+    Return **only** a single valid JSON object in the following structure (no extra text, no markdown, no explanations), with exactly one entry per student_id given:
+
+    {{
+  "results": [
+    {{
+      "student_id": the student_id exactly as given,
+      "grades": [
+        """ + GRADE_ITEM_FORMAT + """
+      ]
     }}
   ]
 }}
-"""
-    )
 
-grade_chain = grade_prompt | llm_grader
+    Questions: {questions}\nModel answers: {model_data}\n
+"""),
+    ("human", "Students (each with its student_id, mappings and student answer chunks): {students}\n"),
+])
+
+@lru_cache(maxsize=None)
+def get_batch_grade_chain(max_tokens):
+    return batch_grade_prompt | _grader_with_budget(max_tokens).with_structured_output(BatchGradingList, method="json_mode")
+
+def _normalize_label(label):
+    """Reduce a subsection label to its bare tag ("(a)" / "a)" -> "a", "1.1." -> "1.1")."""
+    m = _SUBSEC_RE.fullmatch(label)
+    if not m:
+        return label.strip().lower()
+    return (m.group(1) or m.group(2)).lower()
+
+def _deterministic_mappings(student_chunks, model_data):
+    """
+    Map chunks straight from their sub_part labels when those labels already cover
+    every model answer question number (compared after _normalize_label); returns
+    None when the LLM mapping is needed. Chunk ids are 1-based like the map_chain
+    output, and labels that match no model answer are mapped to '0'.
+    """
+    sub_parts = student_chunks.get("sub_parts") or []
+    model_by_label = {_normalize_label(q["question_number"]): q["question_number"] for q in model_data}
+    if not sub_parts or not model_by_label:
+        return None
+    # Two model answers collapsing to one label (e.g. "A)" and "a)") is ambiguous
+    if len(model_by_label) != len({q["question_number"] for q in model_data}):
+        return None
+    student_labels = [_normalize_label(sp["question_number"]) for sp in sub_parts]
+    if not model_by_label.keys() <= set(student_labels):
+        return None
+    return [
+        {"chunk_id": i, "mapped_question_number": model_by_label.get(label, "0")}
+        for i, label in enumerate(student_labels, start=1)
+    ]
+
+def prepare_student(student_pdf_path, student_name, questions_json, model_data, question_number, student_pages):
+    """
+    Extract a student's answers and map them to question numbers.
+    `questions_json` is the already serialized questions payload.
+    Returns (student_chunks, mappings), or None if the PDF is missing or no answers
+    could be extracted.
+    """
+    if not os.path.exists(student_pdf_path):
+        logger.error(f"Student PDF not found: {student_pdf_path}")
+        return None
+
+    student_chunks = extract_answers(student_pdf_path, question_number, student_pages)
+    logger.info(f"Loaded student assignment data for question number: {question_number}")
+    logger.info(f"Student's Assignment: {student_chunks}")
+
+    if not student_chunks:
+        logger.error(f"No answers could be extracted for {student_name}. Skipping grading.")
+        return None
+
+    mappings = _deterministic_mappings(student_chunks, model_data)
+    if mappings is not None:
+        logger.info(f"Sub-part labels match the model answers, skipping LLM mapping for {student_name}: {mappings}")
+        return student_chunks, mappings
+
+    # Map to questions
+    map_output = get_map_chain().invoke({
+        "chunks": student_chunks,
+        "questions": questions_json
+    })
+    
+    # print(map_output)
+    parsed_output = orjson.loads(map_output.content)
+    logger.info(f"Mapped question number to the student assignments: {parsed_output}")
+    # Now you can access the "mappings" list
+    return student_chunks, parsed_output["mappings"]
+
+GRADE_CSV_FIELDS = [
+    "student_id", "question_number", "score", "total_marks", "comment",
+    "correct_lines", "correct_words", "student_answer_snippet"
+]
+
+def save_grades_csv(student_name, grades, student_chunks, model_data):
+    """Write a student's grades (list of GradingItem) to a timestamped CSV and return its path."""
+    # Ensure grades directory exists
+    grades_dir = os.path.join("student_assignment", "grades")
+    os.makedirs(grades_dir, exist_ok=True)
+
+    # Generate output CSV path with timestamp
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    output_csv = os.path.join(grades_dir, f"{student_name}_grades_{timestamp}.csv")
+
+    results = []
+
+
+    all_questions = []
+    for q in model_data:
+        all_questions.append({
+            "question_number": q["question_number"],
+            "maximum_marks": q.get("maximum_marks", "0")
+        })
+    # Index the student's sub-parts once so each grade is a dict lookup
+    student_chunks_dict = {
+        sp["question_number"]: sp for sp in student_chunks.get("sub_parts", [])
+    }
+    # Process graded results
+    for g in grades:
+
+        question_number = g.question_number
+        chunk_text = student_chunks_dict.get(question_number)
+        snippet = (
+            chunk_text["answer"].split("\n")[0][:30]
+            if chunk_text and chunk_text.get("answer")
+            else "No answer provided"
+        )
+        results.append({
+            "student_id": student_name,
+            "question_number": g.question_number,
+            "score": g.score,
+            "total_marks": g.total_marks,
+            "comment": g.comment,
+            "correct_lines": g.correct_lines,
+            "correct_words": g.correct_words,
+            "student_answer_snippet": snippet
+        })
+
+    # Ensure all questions are covered
+    graded_questions = {r["question_number"] for r in results}
+    for q in all_questions:
+        q_num = q["question_number"]
+        if q_num not in graded_questions:
+            results.append({
+                "student_id": student_name,
+                "question_number": q_num,
+                "score": "0",
+                "total_marks": q["maximum_marks"],
+                "comment": "No answer provided",
+                "correct_lines": [],
+                "correct_words": [],
+                "student_answer_snippet": "No answer provided"
+            })
+
+    # Export to CSV (lists are written as their repr, which annotate.py parses back)
+    with open(output_csv, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=GRADE_CSV_FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+    logger.info(f"Grading complete! CSV saved to {output_csv}")
+    return output_csv
 
 def grade_student(input_dir, student_name, questions_path, model_answers_path, question_number, student_pages):
     """Grade a student's PDF and save results to CSV."""
     try:
         # student_pdf_path = os.path.join(input_dir, f"{student_name}.pdf")
         student_pdf_path = input_dir
-        if not os.path.exists(student_pdf_path):
-            logger.error(f"Student PDF not found: {student_pdf_path}")
-            return None
+        # The prompt payloads are serialized once per file version and reused across students
+        questions, model_data, questions_json, model_json = load_prompt_payloads(questions_path, model_answers_path)
 
-        # Ensure grades directory exists
-        grades_dir = os.path.join("student_assignment", "grades")
-        os.makedirs(grades_dir, exist_ok=True)
-
-        # Generate output CSV path with timestamp
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_csv = os.path.join(grades_dir, f"{student_name}_grades_{timestamp}.csv")
-
-        questions, model_data = load_json_data(questions_path, model_answers_path)
-   
-        student_chunks = extract_answers(student_pdf_path, question_number, student_pages)
-        logger.info(f"Loaded student assignment data for question number: {question_number}")
-        logger.info(f"Student's Assignment: {student_chunks}")
-
-        if not student_chunks:
-            logger.error(f"No answers could be extracted for {student_name}. Skipping grading.")
+        prepared = prepare_student(student_pdf_path, student_name, questions_json, model_data, question_number, student_pages)
+        if prepared is None:
             return None
-
-        # Map to questions
-        map_output = map_chain.invoke({
-            "chunks": student_chunks,
-            "questions": json.dumps(questions)
-        })
-        
-        # print(map_output)
-        parsed_output = json.loads(map_output.content)
-        logger.info(f"Mapped question number to the student assignments: {parsed_output}")
-        # Now you can access the "mappings" list
-        mappings = parsed_output["mappings"]
+        student_chunks, mappings = prepared
         
         logger.info(f"Starting grading for {student_name} for question number {question_number}")
-        grade_output = grade_chain.invoke({
+        max_tokens = grader_max_tokens(len(orjson.dumps(student_chunks)), len(model_data))
+        grade_output = retry_grader_invoke(get_grade_chain(max_tokens), {
             "mappings": mappings,
-            "model_data": json.dumps(model_data),
+            "model_data": model_json,
             "chunks": student_chunks,
-            "questions": json.dumps(questions)
+            "questions": questions_json
         })
         logger.info(f"Grading done saving data into csv for: {student_name}")
-        # print(grade_output)
-        raw_content = grade_output.content
-        cleaned_json_str = re.sub(r"^```json\n|```$", "", raw_content.strip())
-        parsed_output = json.loads(cleaned_json_str)
-    
-        results = []
-
+        return save_grades_csv(student_name, grade_output.grades, student_chunks, model_data)
+    except Exception as e:
+        logger.error(f"Error during grading for {student_name}: {e}")
+        return None
 
-        all_questions = []
-        for q in model_data:
-            all_questions.append({
-                "question_number": q["question_number"],
-                "maximum_marks": q.get("maximum_marks", "0")
-            })
-        # Process graded results
-        for g in parsed_output['grades']:
-
-            question_number = g["question_number"]
-            student_chunks_dict = {
-                sp["question_number"]: sp for sp in student_chunks.get("sub_parts", [])
-            }
-
-            # Then you can safely do:
-            chunk_text = student_chunks_dict.get(question_number)
-            snippet = (
-                chunk_text["answer"].split("\n")[0][:30]
-                if chunk_text and chunk_text.get("answer")
-                else "No answer provided"
+def _prepare_students(students, questions_json, model_data, question_number, max_workers=None):
+    """
+    Run prepare_student for each student dict (student_pdf_path, student_name,
+    student_pages) on up to `max_workers` threads (default min(16, number of
+    students)), so the extraction and mapping LLM calls of different students
+    overlap; PDF_LOCK still serializes the PyMuPDF work. Returns (results, prepared):
+    results maps students that could not be prepared to None, prepared maps the
+    others to (student_chunks, mappings), in input order.
+    """
+    def prepare_one(student):
+        name = student["student_name"]
+        try:
+            return name, prepare_student(
+                student["student_pdf_path"], name, questions_json, model_data, question_number, student["student_pages"]
             )
-            results.append({
-                "student_id": student_name,
-                "question_number": g["question_number"],
-                "score": g["score"],
-                "total_marks": g["total_marks"],
-                "comment": g["comment"],
-                "correct_lines": g["correct_lines"],
-                "correct_words": g["correct_words"],
-                "student_answer_snippet": snippet
+        except Exception as e:
+            logger.error(f"Error preparing {name} for batch grading: {e}")
+            return name, None
+
+    results = {}
+    prepared = {}
+    if not students:
+        return results, prepared
+    with ThreadPoolExecutor(max_workers=max_workers or min(16, len(students))) as executor:
+        for name, outcome in executor.map(prepare_one, students):
+            if outcome is None:
+                results[name] = None
+            else:
+                prepared[name] = outcome
+    return results, prepared
+
+def _save_graded(name, grades, student_chunks, model_data, results, on_graded=None):
+    """Write a student's grades CSV into `results` and hand it to `on_graded(name, csv_path)` right away."""
+    csv_path = save_grades_csv(name, grades, student_chunks, model_data)
+    results[name] = csv_path
+    if on_graded is not None and csv_path:
+        on_graded(name, csv_path)
+
+def _grade_individually(entries, model_data, questions_json, model_json, results, max_workers=None, on_graded=None):
+    """
+    Grade each {student_id, mappings, chunks} entry with its own grade_chain call,
+    filling `results`. Calls run on up to `max_workers` threads (default
+    min(16, number of entries)) so their LLM round-trips overlap.
+    """
+    def grade_one(entry):
+        name = entry["student_id"]
+        try:
+            max_tokens = grader_max_tokens(len(orjson.dumps(entry["chunks"])), len(model_data))
+            grade_output = retry_grader_invoke(get_grade_chain(max_tokens), {
+                "mappings": entry["mappings"],
+                "model_data": model_json,
+                "chunks": entry["chunks"],
+                "questions": questions_json
             })
+            _save_graded(name, grade_output.grades, entry["chunks"], model_data, results, on_graded)
+        except Exception as e:
+            logger.error(f"Error during grading for {name}: {e}")
+            results[name] = None
+
+    if not entries:
+        return
+    with ThreadPoolExecutor(max_workers=max_workers or min(16, len(entries))) as executor:
+        list(executor.map(grade_one, entries))
+
+def grade_students_batch(
+    students, questions_path, model_answers_path, question_number,
+    batch_size=GRADING_BATCH_SIZE, max_concurrency=None, on_graded=None
+):
+    """
+    Grade several students for the same question with one grading LLM call per
+    batch of up to `batch_size` students; students are prepared and batches graded
+    concurrently, at most `max_concurrency` LLM calls at a time (default
+    min(16, number of students) for preparation, unlimited for grading).
+
+    Each entry of `students` is a dict with student_pdf_path, student_name and
+    student_pages (names must be unique). Batches that would exceed
+    MAX_BATCH_PROMPT_TOKENS, failed batches and students missing from a batch
+    response fall back to per-student grading. `on_graded(name, csv_path)` is
+    called (from worker threads) as soon as each student's CSV is written, so
+    callers can start downstream work before the whole cohort is graded.
+
+    Returns:
+        Dict: student_name -> CSV path, or None if grading failed.
+    """
+    questions, model_data, questions_json, model_json = load_prompt_payloads(questions_path, model_answers_path)
+    results, prepared = _prepare_students(students, questions_json, model_data, question_number, max_concurrency)
+
+    # Group students under both the batch size and the prompt token budget (~4 chars per token)
+    shared_tokens = (len(questions_json) + len(model_json)) // 4
+    batches, current, current_tokens = [], [], shared_tokens
+    for name, (student_chunks, mappings) in prepared.items():
+        entry = {"student_id": name, "mappings": mappings, "chunks": student_chunks}
+        tokens = len(orjson.dumps(entry)) // 4
+        if current and (len(current) >= batch_size or current_tokens + tokens > MAX_BATCH_PROMPT_TOKENS):
+            batches.append(current)
+            current, current_tokens = [], shared_tokens
+        current.append(entry)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+
+    multi = [batch for batch in batches if len(batch) > 1]
+    fallback = [batch[0] for batch in batches if len(batch) == 1]
+
+    logger.info(f"Grading {len(prepared)} students in {len(multi)} batches and {len(fallback)} single calls")
+    students_payloads = [orjson.dumps(batch).decode() for batch in multi]
+    # One chain serves every batch, so size its budget for the largest one
+    max_tokens = max(
+        (grader_max_tokens(len(payload), len(model_data), students=len(batch)) for payload, batch in zip(students_payloads, multi)),
+        default=GRADER_MAX_TOKENS_CAP
+    )
+    # Save each batch as soon as it returns, so its students reach on_graded early
+    for i, output in retry_grader_batch_as_completed(
+        get_batch_grade_chain(max_tokens),
+        [{"students": payload, "model_data": model_json, "questions": questions_json} for payload in students_payloads],
+        max_concurrency
+    ):
+        batch = multi[i]
+        if isinstance(output, Exception):
+            logger.error(f"Batch grading failed, falling back to per-student grading: {output}")
+            fallback.extend(batch)
+            continue
+        graded = {r.student_id: r.grades for r in output.results}
+        for entry in batch:
+            name = entry["student_id"]
+            if name in graded:
+                _save_graded(name, graded[name], entry["chunks"], model_data, results, on_graded)
+            else:
+                logger.warning(f"{name} missing from batch grading response, grading individually")
+                fallback.append(entry)
+
+    _grade_individually(fallback, model_data, questions_json, model_json, results, max_concurrency, on_graded)
+    return results
+
+def grade_students_offline(students, questions_path, model_answers_path, question_number, on_graded=None):
+    """
+    Grade a whole class for one question through the provider's asynchronous Batch
+    API (see llm_setup.submit_grading_batch): every student's grading prompt is
+    uploaded in one job instead of one live request per student. Slower to complete
+    but billed at batch rates; students whose batch response is missing or invalid
+    are re-graded with live grade_chain calls. `on_graded(name, csv_path)` is called
+    as soon as each student's CSV is written.
 
-        # Ensure all questions are covered
-        graded_questions = {r["question_number"] for r in results}
-        for q in all_questions:
-            q_num = q["question_number"]
-            if q_num not in graded_questions:
-                results.append({
-                    "student_id": student_name,
-                    "question_number": q_num,
-                    "score": "0",
-                    "total_marks": q["maximum_marks"],
-                    "comment": "No answer provided",
-                    "correct_lines": [],
-                    "correct_words": [],
-                    "student_answer_snippet": "No answer provided"
-                })
-
-        # Export to CSV
-        df = pd.DataFrame(results)
-        df.to_csv(output_csv, index=False)
-        logger.info(f"Grading complete! CSV saved to {output_csv}")
-        return output_csv
+    Returns:
+        Dict: student_name -> CSV path, or None if grading failed.
+    """
+    questions, model_data, questions_json, model_json = load_prompt_payloads(questions_path, model_answers_path)
+    results, prepared = _prepare_students(students, questions_json, model_data, question_number)
+    if not prepared:
+        return results
+
+    entries = {
+        name: {"student_id": name, "mappings": mappings, "chunks": student_chunks}
+        for name, (student_chunks, mappings) in prepared.items()
+    }
+    requests = {
+        name: convert_to_openai_messages(grade_prompt.format_messages(
+            mappings=entry["mappings"], model_data=model_json, chunks=entry["chunks"], questions=questions_json
+        ))
+        for name, entry in entries.items()
+    }
+
+    try:
+        max_tokens = max(grader_max_tokens(len(orjson.dumps(entry["chunks"])), len(model_data)) for entry in entries.values())
+        responses = submit_grading_batch(requests, max_tokens)
     except Exception as e:
-        logger.error(f"Error during grading for {student_name}: {e}")
-        return None
\ No newline at end of file
+        logger.error(f"Batch API grading failed, falling back to live grading: {e}")
+        responses = {}
+
+    fallback = []
+    for name, entry in entries.items():
+        try:
+            grades = GradingList.model_validate_json(responses[name]).grades
+        except Exception as e:
+            logger.warning(f"No usable batch response for {name}, grading individually: {e!r}")
+            fallback.append(entry)
+            continue
+        _save_graded(name, grades, entry["chunks"], model_data, results, on_graded)
+
+    _grade_individually(fallback, model_data, questions_json, model_json, results, on_graded=on_graded)
+    return results
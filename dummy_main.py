@@ -1,30 +1,128 @@
 import os
-from dummy_grade import grade_student
+import logging
+import asyncio
+import hashlib
+import orjson
+import multiprocessing
+import threading
+from dataclasses import dataclass
+from functools import lru_cache, partial
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from dummy_grade import grade_student, grade_students_batch, grade_students_offline
 from annotate import annotate_pdf
 from data_preprocessing_latest import extract_and_save_question_answer
-from logging_config import logger
+from logging_config import configure_logging, logger
+
+# Maximum number of LLM calls (student preparation and grading) in flight at once in process_exam_batch
+PIPELINE_CONCURRENCY = int(os.getenv("PIPELINE_CONCURRENCY", "8"))
+# LLM calls in flight for process_exam_for_cohort; unset means min(16, number of students)
+PAC_GRADER_WORKERS = int(os.getenv("PAC_GRADER_WORKERS", "0")) or None
+# Processes used for annotation; unset means one less than the CPU count (at least 2)
+ANNOTATION_WORKERS = int(os.getenv("ANNOTATION_WORKERS", "0")) or max(2, (os.cpu_count() or 2) - 1)
+
+# Extraction results are reused across runs when the PDFs, pages and question are unchanged
+EXTRACT_CACHE_DIR = os.path.join("cache", "extract")
+
+
+
+@dataclass(frozen=True)
+class StudentPaths:
+    """Per-student output locations, derived once from the output directory and name."""
+    dir: Path
+    annotated_pdf: Path
+
+
+@lru_cache(maxsize=1024)
+def student_paths(output_dir, student_name):
+    """Build (and memoize) the StudentPaths for a student."""
+    name_l = student_name.lower()
+    student_dir = Path(output_dir) / name_l
+    return StudentPaths(student_dir, student_dir / f"{name_l}_annotated.pdf")
+
+
+_annotation_pool = None
+_annotation_pool_lock = threading.Lock()
+
+
+def get_annotation_pool():
+    """
+    Process pool shared by every annotation, created on first use. Annotation is
+    CPU-bound PyMuPDF work; separate processes run it in parallel, free of the GIL
+    and of PyMuPDF's one-thread-per-process restriction. Workers are spawned rather
+    than forked because the parent already runs logging and HTTP threads. Created
+    under a lock so concurrent first callers cannot each start their own pool.
+    """
+    global _annotation_pool
+    with _annotation_pool_lock:
+        if _annotation_pool is None:
+            _annotation_pool = ProcessPoolExecutor(
+                max_workers=ANNOTATION_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=configure_logging
+            )
+        return _annotation_pool
+
+
+@lru_cache(maxsize=64)
+def _file_digest(path, mtime, size):
+    """blake2b of a file's contents; mtime and size key the memo so edited files are re-hashed."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _extraction_cache_key(question_pdf_path, question_pages, model_answer_pdf_path, answer_pages, question_num):
+    """Cache key built from both PDFs' contents plus the requested pages and question."""
+    h = hashlib.blake2b(digest_size=16)
+    for path, pages in ((question_pdf_path, question_pages), (model_answer_pdf_path, answer_pages)):
+        st = os.stat(path)
+        h.update(_file_digest(path, st.st_mtime, st.st_size).encode())
+        h.update(repr(list(pages)).encode())
+    h.update(str(question_num).encode())
+    return h.hexdigest()
 
 def extract_question_and_model_answer(question_pdf_path, question_pages, model_answer_pdf_path, answer_pages, question_num):
     """Extract question and model answer, return JSON paths."""
     try:
-        logger.info(f"Starting extraction for Question {question_num}")
+        key = _extraction_cache_key(question_pdf_path, question_pages, model_answer_pdf_path, answer_pages, question_num)
+        meta_path = os.path.join(EXTRACT_CACHE_DIR, f"{key}.meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "rb") as f:
+                meta = orjson.loads(f.read())
+            if os.path.exists(meta["questions_path"]) and os.path.exists(meta["model_answers_path"]):
+                logger.info("Reusing cached extraction for Question %s", question_num)
+                return True, meta["questions_path"], meta["model_answers_path"]
+
+        logger.info("Starting extraction for Question %s", question_num)
         questions_path, model_answers_path = extract_and_save_question_answer(
             question_pdf_path, question_pages,
             model_answer_pdf_path, answer_pages,
             question_num
         )
-        logger.info(f"Extraction completed successfully for Question {question_num}")
+        logger.info("Extraction completed successfully for Question %s", question_num)
+
+        # Write the cache entry atomically so concurrent runs never read a partial file
+        os.makedirs(EXTRACT_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{meta_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps({"questions_path": questions_path, "model_answers_path": model_answers_path}))
+        os.replace(tmp_path, meta_path)
         return True, questions_path, model_answers_path
 
     except Exception as e:
-        logger.exception(f"Extraction failed for Question {question_num}: {e}")
+        logger.exception("Extraction failed for Question %s: %s", question_num, e)
         return False, None, None
 
 
-def grade_and_annotate_student(student_pdf_path, student_name, questions_path, model_answers_path, question_num, student_pages, output_dir):
-    """Grade and annotate student work."""
+def grade_and_annotate_student(student_pdf_path, student_name, questions_path, model_answers_path, question_num, student_pages, output_dir, paths=None):
+    """Grade and annotate student work. `paths` (StudentPaths) defaults to student_paths(output_dir, student_name)."""
+    if paths is None:
+        paths = student_paths(output_dir, student_name)
     try:
-        logger.info(f"Starting grading for student '{student_name}' - Question {question_num}")
+        logger.info("Starting grading for student '%s' - Question %s", student_name, question_num)
 
         # Grade
         grades_csv_path = grade_student(
@@ -33,35 +131,85 @@ def grade_and_annotate_student(student_pdf_path, student_name, questions_path, m
         )
 
         if not grades_csv_path:
-            logger.warning(f"Grading failed for {student_name} (Question {question_num})")
+            logger.warning("Grading failed for %s (Question %s)", student_name, question_num)
             return False, "Grading failed", None
 
-        logger.info(f"Grading complete, results saved to CSV for {student_name} (Question {question_num})")
+        logger.info("Grading complete, results saved to CSV for %s (Question %s)", student_name, question_num)
 
         # Annotate
-        logger.info(f"Starting annotation for {student_name} (Question {question_num})")
-        success = annotate_pdf(student_pdf_path, output_dir, student_name, grades_csv_path)
+        logger.info("Starting annotation for %s (Question %s)", student_name, question_num)
+        success = submit_annotation(student_pdf_path, student_name, grades_csv_path, output_dir, paths).result()
 
         if success:
-            annotated_path = os.path.join(output_dir, student_name.lower(), f"{student_name.lower()}_annotated.pdf")
-            logger.info(f"Annotation completed successfully for {student_name} (Question {question_num})")
-            return True, "Processing completed", annotated_path
+            logger.info("Annotation completed successfully for %s (Question %s)", student_name, question_num)
+            return True, "Processing completed", paths.annotated_pdf
         else:
-            logger.error(f"Annotation failed for {student_name} (Question {question_num})")
+            logger.error("Annotation failed for %s (Question %s)", student_name, question_num)
             return False, "Annotation failed", None
 
     except Exception as e:
-        logger.exception(f"Grading/annotation failed for {student_name} (Question {question_num}): {e}")
+        logger.exception("Grading/annotation failed for %s (Question %s): %s", student_name, question_num, e)
         return False, str(e), None
 
 
+def submit_annotation(student_pdf_path, student_name, grades_csv_path, output_dir, paths=None):
+    """Create the student's output directory and start annotate_pdf on the process pool; returns the future."""
+    if paths is None:
+        paths = student_paths(output_dir, student_name)
+    paths.dir.mkdir(parents=True, exist_ok=True)
+    return get_annotation_pool().submit(
+        annotate_pdf, student_pdf_path, output_dir, student_name, grades_csv_path, paths.annotated_pdf
+    )
+
+
+def grade_and_annotate_students(grade, students, output_dir, question_num):
+    """
+    Grade a cohort with `grade(on_graded=...)` (a partial of grade_students_batch or
+    grade_students_offline) and submit each student's annotation to the process pool
+    as soon as their grades CSV is written, so annotation overlaps the LLM calls of
+    the students still being graded.
+
+    Returns:
+        List: one (success, message, annotated_path) per student, in order.
+    """
+    pdf_paths = {student["student_name"]: student["student_pdf_path"] for student in students}
+    futures = {}
+
+    def on_graded(student_name, grades_csv_path):
+        futures[student_name] = submit_annotation(pdf_paths[student_name], student_name, grades_csv_path, output_dir)
+
+    grade(on_graded=on_graded)
+
+    results = []
+    for student in students:
+        student_name = student["student_name"]
+        future = futures.get(student_name)
+        if future is None:
+            logger.warning("Grading failed for %s (Question %s)", student_name, question_num)
+            results.append((False, "Grading failed", None))
+            continue
+        try:
+            success = future.result()
+        except Exception as e:
+            logger.exception("Annotation failed for %s (Question %s): %s", student_name, question_num, e)
+            success = False
+        if success:
+            results.append((True, "Processing completed", student_paths(output_dir, student_name).annotated_pdf))
+        else:
+            logger.error("Annotation failed for %s (Question %s)", student_name, question_num)
+            results.append((False, "Annotation failed", None))
+
+    return results
+
+
 def process_exam(
     question_pdf_path, question_pages, model_answer_pdf_path, answer_pages, question_num,
     student_pdf_path, student_pages, output_dir, student_name
 ):
     """Complete exam processing pipeline."""
-    logger.info("=" * 60)
-    logger.info(f"📘 Starting processing pipeline for student '{student_name}' (Question {question_num})")
+    paths = student_paths(output_dir, student_name)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("===== 📘 Starting processing pipeline for student '%s' (Question %s) =====", student_name, question_num)
     
     # Step 1: Extract
     extract_success, questions_path, model_answers_path = extract_question_and_model_answer(
@@ -69,24 +217,123 @@ def process_exam(
     )
 
     if not extract_success:
-        logger.error(f"Extraction failed for Question {question_num}")
+        logger.error("Extraction failed for Question %s", question_num)
         return False, "Extraction failed", None, None
 
     # Step 2: Grade & Annotate
     grade_success, message, annotated_path = grade_and_annotate_student(
         student_pdf_path, student_name, questions_path, model_answers_path,
-        question_num, student_pages, output_dir
+        question_num, student_pages, output_dir, paths
     )
 
     if grade_success:
-        logger.info(f"✅ Completed processing for {student_name} (Question {question_num})")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("===== ✅ Completed processing for %s (Question %s) =====", student_name, question_num)
     else:
-        logger.warning(f"⚠️ Processing incomplete for {student_name} (Question {question_num}) — {message}")
-
-    logger.info("=" * 60)
+        logger.warning("⚠️ Processing incomplete for %s (Question %s) — %s", student_name, question_num, message)
     return grade_success, message, questions_path, model_answers_path
 
 
+async def process_exam_batch(
+    question_pdf_path, question_pages, model_answer_pdf_path, answer_pages, question_num,
+    students, output_dir, concurrency=PIPELINE_CONCURRENCY
+):
+    """
+    Run the pipeline for several students answering the same question.
+
+    The question and model answer are extracted once, then students are graded
+    several per LLM call (see dummy_grade.grade_students_batch, at most
+    `concurrency` LLM calls at a time), each one annotated on the process pool as
+    soon as their grades are saved. Each entry of `students` is a dict with student_pdf_path, student_pages
+    and student_name.
+
+    Returns:
+        Tuple: (extract_success, results, questions_path, model_answers_path) where
+        results holds one (success, message, annotated_path) per student, in order.
+    """
+    extract_success, questions_path, model_answers_path = await asyncio.to_thread(
+        extract_question_and_model_answer,
+        question_pdf_path, question_pages, model_answer_pdf_path, answer_pages, question_num
+    )
+    if not extract_success:
+        logger.error("Extraction failed for Question %s", question_num)
+        return False, [], None, None
+
+    grade = partial(grade_students_batch, students, questions_path, model_answers_path, question_num, max_concurrency=concurrency)
+    results = await asyncio.to_thread(grade_and_annotate_students, grade, students, output_dir, question_num)
+    completed = sum(1 for success, _, _ in results if success)
+    logger.info("Batch for Question %s finished: %s/%s students processed", question_num, completed, len(students))
+    return True, results, questions_path, model_answers_path
+
+
+def process_exam_for_cohort(question_ctx, students, output_dir, max_workers=None):
+    """
+    Synchronous counterpart of process_exam_batch for callers without an event loop.
+
+    `question_ctx` holds question_pdf_path, question_pages, model_answer_pdf_path,
+    answer_pages and question_num. The question is extracted once, then students
+    (dicts with student_pdf_path, student_pages and student_name) are graded several
+    per LLM call with at most `max_workers` LLM calls in flight
+    (PAC_GRADER_WORKERS, else min(16, number of students)), each one annotated on
+    the process pool as soon as their grades are saved.
+
+    Returns:
+        Tuple: (extract_success, results, questions_path, model_answers_path) where
+        results holds one (success, message, annotated_path) per student, in order.
+    """
+    question_num = question_ctx["question_num"]
+    extract_success, questions_path, model_answers_path = extract_question_and_model_answer(
+        question_ctx["question_pdf_path"], question_ctx["question_pages"],
+        question_ctx["model_answer_pdf_path"], question_ctx["answer_pages"], question_num
+    )
+    if not extract_success:
+        logger.error("Extraction failed for Question %s", question_num)
+        return False, [], None, None
+    if not students:
+        return True, [], questions_path, model_answers_path
+
+    workers = max_workers or PAC_GRADER_WORKERS or min(16, len(students))
+    grade = partial(grade_students_batch, students, questions_path, model_answers_path, question_num, max_concurrency=workers)
+    results = grade_and_annotate_students(grade, students, output_dir, question_num)
+
+    completed = sum(1 for success, _, _ in results if success)
+    logger.info("Cohort for Question %s finished: %s/%s students processed", question_num, completed, len(students))
+    return True, results, questions_path, model_answers_path
+
+
+def process_exam_classroom(
+    question_pdf_path, question_pages, model_answer_pdf_path, answer_pages, question_num,
+    students, output_dir
+):
+    """
+    Run the pipeline for a whole class through the provider's Batch API.
+
+    The question and model answer are extracted once, all students' grading prompts
+    are submitted as a single batch job (see dummy_grade.grade_students_offline) and
+    each student is annotated as soon as their grades are saved. Intended for offline runs where waiting
+    for the batch to finish is acceptable. Each entry of `students` is a dict with
+    student_pdf_path, student_pages and student_name.
+
+    Returns:
+        Tuple: (extract_success, results, questions_path, model_answers_path) where
+        results holds one (success, message, annotated_path) per student, in order.
+    """
+    extract_success, questions_path, model_answers_path = extract_question_and_model_answer(
+        question_pdf_path, question_pages, model_answer_pdf_path, answer_pages, question_num
+    )
+    if not extract_success:
+        logger.error("Extraction failed for Question %s", question_num)
+        return False, [], None, None
+
+    grade = partial(grade_students_offline, students, questions_path, model_answers_path, question_num)
+    results = grade_and_annotate_students(grade, students, output_dir, question_num)
+
+    completed = sum(1 for success, _, _ in results if success)
+    logger.info("Classroom run for Question %s finished: %s/%s students processed", question_num, completed, len(students))
+    return True, results, questions_path, model_answers_path
+
+
 # Optional: Direct test entry
 if __name__ == "__main__":
+    configure_logging()
     logger.info("Running exam pipeline test mode (no actual grading executed).")
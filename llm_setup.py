@@ -1,33 +1,318 @@
-from langchain_together import ChatTogether
-from langchain_groq import ChatGroq
-from langchain_openai import ChatOpenAI
+from langchain_core.globals import set_llm_cache
+from langchain_community.cache import SQLiteCache
+from functools import lru_cache, wraps
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tenacity import Retrying, before_sleep_log, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from logging_config import logger
+import atexit
+import logging
 import os
-from dotenv import load_dotenv
+import threading
+import time
+import orjson
 
-load_dotenv()
-groq_api = os.getenv("GROQ_API_KEY")
+# Only read .env when the key is not already provided by the environment
+if not os.getenv("TOGETHER_API_KEY"):
+    from dotenv import load_dotenv
+    load_dotenv()
 together_api = os.getenv("TOGETHER_API_KEY")
-openai_api = os.getenv("OPENAI_API_KEY")
-
-
-llm_grader = ChatTogether(
-    # model="openai/gpt-oss-20b",
-    model = "talhapacahmed_9091/gpt-oss-20b-78eb5223-03bd6cc1",
-    temperature=0,
-    api_key= together_api,
-    max_tokens=80000
-)
-
-# llm_grader = ChatTogether(
-#     model="openai/gpt-oss-20b",
-#     temperature=0,
-#     api_key= together_api,
-#     max_tokens=80000
-# )
-
-llm = ChatTogether(
-    model="openai/gpt-oss-20b",
-    temperature=0,
-    api_key= together_api,
-    max_tokens=80000
-)
\ No newline at end of file
+
+def _is_truncated(generations):
+    """True if any generation stopped on the max_tokens limit (finish_reason "length")."""
+    for gen in generations:
+        info = gen.generation_info or {}
+        message = getattr(gen, "message", None)
+        reason = info.get("finish_reason") or (message.response_metadata.get("finish_reason") if message else None)
+        if reason == "length":
+            return True
+    return False
+
+
+class CompleteResponseSQLiteCache(SQLiteCache):
+    """SQLiteCache that never stores or serves responses cut off by max_tokens."""
+
+    def lookup(self, prompt, llm_string):
+        cached = super().lookup(prompt, llm_string)
+        if cached and _is_truncated(cached):
+            return None
+        return cached
+
+    def update(self, prompt, llm_string, return_val):
+        if _is_truncated(return_val):
+            logger.warning("Not caching a response truncated by max_tokens")
+            return
+        super().update(prompt, llm_string, return_val)
+
+
+# lru_cache alone lets two threads both run a builder on a cold cache, leaking the
+# extra HTTP pool/client; builders decorated with _build_once run under this lock
+_build_lock = threading.RLock()
+
+
+def _build_once(builder):
+    """lru_cache a zero-argument builder so concurrent first calls still build a single instance."""
+    cached = lru_cache(maxsize=None)(builder)
+
+    @wraps(builder)
+    def getter():
+        with _build_lock:
+            return cached()
+    getter.cache_clear = cached.cache_clear
+    return getter
+
+
+@_build_once
+def install_llm_cache():
+    """
+    Exact-match response cache shared by every chain: re-running extraction or grading
+    with the same prompt and model settings is served from disk instead of the API.
+    Truncated responses are skipped so a larger budget or a retry gets a fresh call.
+    Installed by the first model client build, so importing this module does not
+    create the SQLite database.
+    """
+    cache = CompleteResponseSQLiteCache(database_path=os.getenv("LLM_CACHE_PATH", ".llm_cache.db"))
+    set_llm_cache(cache)
+    return cache
+
+
+# Upper bound for one request; grading responses can take minutes to generate
+LLM_HTTP_TIMEOUT = float(os.getenv("LLM_HTTP_TIMEOUT", "600"))
+
+
+@_build_once
+def get_http_client():
+    """
+    Pooled HTTP/2 client shared by every model client, so concurrent calls from the
+    pipeline's worker threads reuse connections instead of each opening its own.
+    Only the sync client is shared: an httpx.AsyncClient is bound to the event loop
+    it was first used on. Model clients also pass this client's timeout explicitly,
+    since the SDK's per-request timeout overrides the one configured here.
+    """
+    import httpx
+    client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        timeout=httpx.Timeout(LLM_HTTP_TIMEOUT, connect=5)
+    )
+    atexit.register(client.close)
+    return client
+
+
+# Clients are built on first use and shared afterwards, so code paths that never
+# call a model (annotation, imports in worker processes) do not construct them
+@_build_once
+def get_llm_grader():
+    """Return the shared grading model client."""
+    from langchain_together import ChatTogether
+    install_llm_cache()
+    http_client = get_http_client()
+    return ChatTogether(
+        # model="openai/gpt-oss-20b",
+        model = "talhapacahmed_9091/gpt-oss-20b-78eb5223-03bd6cc1",
+        temperature=0,
+        api_key= together_api,
+        # No default max_tokens: dummy_grade sizes the output budget per call
+        # The SDK's own timeout (None by default) would override the shared client's
+        timeout=http_client.timeout,
+        # retry_grader_invoke owns retries, so every failed HTTP call reaches its circuit breaker
+        max_retries=0,
+        http_client=http_client
+    )
+
+# def get_llm_grader():
+#     return ChatTogether(
+#         model="openai/gpt-oss-20b",
+#         temperature=0,
+#         api_key= together_api,
+#         max_tokens=80000
+#     )
+
+@_build_once
+def get_llm():
+    """Return the shared extraction/mapping model client."""
+    from langchain_together import ChatTogether
+    install_llm_cache()
+    http_client = get_http_client()
+    return ChatTogether(
+        model="openai/gpt-oss-20b",
+        temperature=0,
+        api_key= together_api,
+        max_tokens=80000,
+        timeout=http_client.timeout,
+        http_client=http_client
+    )
+
+
+# Retries for transient grader failures, and the circuit breaker that stops calling the
+# provider for GRADER_CIRCUIT_COOLDOWN seconds once GRADER_CIRCUIT_THRESHOLD failures
+# happen within GRADER_CIRCUIT_WINDOW seconds
+GRADER_RETRY_ATTEMPTS = int(os.getenv("GRADER_RETRY_ATTEMPTS", "5"))
+GRADER_CIRCUIT_THRESHOLD = int(os.getenv("GRADER_CIRCUIT_THRESHOLD", "5"))
+GRADER_CIRCUIT_WINDOW = float(os.getenv("GRADER_CIRCUIT_WINDOW", "60"))
+GRADER_CIRCUIT_COOLDOWN = float(os.getenv("GRADER_CIRCUIT_COOLDOWN", "30"))
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling the grader while its circuit breaker is open."""
+
+
+class _CircuitBreaker:
+    """Opens after `threshold` failures within `window` seconds and stays open for `cooldown` seconds."""
+
+    def __init__(self, threshold, window, cooldown):
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+        self._failures = deque()
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    def check(self):
+        with self._lock:
+            remaining = self._open_until - time.monotonic()
+        if remaining > 0:
+            raise CircuitOpenError(f"Grader circuit open for another {remaining:.0f}s after repeated provider failures")
+
+    def record_failure(self):
+        now = time.monotonic()
+        with self._lock:
+            self._failures.append(now)
+            while self._failures and now - self._failures[0] > self.window:
+                self._failures.popleft()
+            if len(self._failures) >= self.threshold:
+                self._open_until = now + self.cooldown
+                self._failures.clear()
+                logger.warning("Grader circuit opened for %.0fs after %d failures", self.cooldown, self.threshold)
+
+
+_grader_circuit = _CircuitBreaker(GRADER_CIRCUIT_THRESHOLD, GRADER_CIRCUIT_WINDOW, GRADER_CIRCUIT_COOLDOWN)
+
+
+@lru_cache(maxsize=None)
+def _transient_errors():
+    """Provider errors worth retrying: rate limits, connection problems/timeouts and 5xx."""
+    from openai import APIConnectionError, InternalServerError, RateLimitError
+    return (RateLimitError, APIConnectionError, InternalServerError)
+
+
+def retry_grader_invoke(runnable, inputs):
+    """
+    Invoke a grading chain with retries (exponential backoff with jitter) on transient
+    provider errors. Every failed attempt counts towards the circuit breaker until it
+    ages out of the window (successes do not reset it); while the breaker is open,
+    calls raise CircuitOpenError immediately instead of hitting the API.
+    """
+    transient = _transient_errors()
+
+    def attempt():
+        _grader_circuit.check()
+        try:
+            return runnable.invoke(inputs)
+        except transient:
+            _grader_circuit.record_failure()
+            raise
+
+    retrying = Retrying(
+        wait=wait_exponential_jitter(initial=1, max=30),
+        stop=stop_after_attempt(GRADER_RETRY_ATTEMPTS),
+        retry=retry_if_exception_type(transient),
+        before_sleep=before_sleep_log(logger, logging.WARNING),
+        reraise=True
+    )
+    return retrying(attempt)
+
+
+def retry_grader_batch_as_completed(runnable, inputs, max_concurrency=None):
+    """
+    retry_grader_invoke over several inputs on up to `max_concurrency` threads
+    (default one per input), yielding (index, result) pairs as each call finishes,
+    like Runnable.batch_as_completed(return_exceptions=True): failures are yielded
+    in place of their result.
+    """
+    def run(i, item):
+        try:
+            return i, retry_grader_invoke(runnable, item)
+        except Exception as e:
+            return i, e
+
+    if not inputs:
+        return
+    with ThreadPoolExecutor(max_workers=max_concurrency or len(inputs)) as executor:
+        futures = [executor.submit(run, i, item) for i, item in enumerate(inputs)]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+# Batch jobs go through the OpenAI SDK's files/batches calls against Together by default.
+# Together expects batch input files uploaded with purpose "batch-api"; set
+# BATCH_FILE_PURPOSE=batch when pointing BATCH_API_BASE_URL at OpenAI instead
+BATCH_API_BASE_URL = os.getenv("BATCH_API_BASE_URL", "https://api.together.xyz/v1")
+BATCH_FILE_PURPOSE = os.getenv("BATCH_FILE_PURPOSE", "batch-api")
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "30"))
+BATCH_TIMEOUT = float(os.getenv("BATCH_TIMEOUT", str(24 * 3600)))
+
+
+def submit_grading_batch(requests, max_tokens=None):
+    """
+    Run many grading prompts as one asynchronous Batch API job with the grader model.
+
+    Args:
+        requests: Dict of custom_id (e.g. student name) -> list of OpenAI-style chat
+            messages ({"role": ..., "content": ...}).
+        max_tokens: Output budget per request; None leaves it to the provider default.
+
+    Returns:
+        Dict: custom_id -> response message content for every request that succeeded.
+        Failed requests are simply absent.
+    """
+    from openai import OpenAI  # only needed for batch jobs
+
+    client = OpenAI(
+        api_key=os.getenv("BATCH_API_KEY", together_api),
+        base_url=BATCH_API_BASE_URL,
+        http_client=get_http_client()
+    )
+    body_defaults = {
+        "model": get_llm_grader().model_name,
+        "temperature": 0,
+        "response_format": {"type": "json_object"}
+    }
+    if max_tokens is not None:
+        body_defaults["max_tokens"] = max_tokens
+    lines = [
+        orjson.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {**body_defaults, "messages": messages}
+        })
+        for custom_id, messages in requests.items()
+    ]
+    batch_file = client.files.create(file=("grading_batch.jsonl", b"\n".join(lines)), purpose=BATCH_FILE_PURPOSE)
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+
+    deadline = time.monotonic() + BATCH_TIMEOUT
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Grading batch {batch.id} did not finish within {BATCH_TIMEOUT:.0f}s")
+        time.sleep(BATCH_POLL_INTERVAL)
+        batch = client.batches.retrieve(batch.id)
+
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"Grading batch {batch.id} ended with status {batch.status}")
+
+    responses = {}
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        record = orjson.loads(line)
+        body = (record.get("response") or {}).get("body") or {}
+        choices = body.get("choices") or []
+        if choices:
+            responses[record["custom_id"]] = choices[0]["message"]["content"]
+    return responses
@@ -0,0 +1,5 @@
+import threading
+
+# PyMuPDF is not thread-safe; every thread that opens or reads a document in this
+# process (student answer extraction, question/model answer extraction) holds this lock
+PDF_LOCK = threading.Lock()
@@ -0,0 +1,73 @@
+"""Pydantic schemas shared by the extraction and grading pipelines."""
+from pydantic import BaseModel, ConfigDict, Field
+from typing import List, Optional
+
+
+# Model answer extraction (marking guide)
+class SubAnswer(BaseModel):
+    question_number: str = Field(description="Subquestion number like '1.1' or 'a)'")
+    answer: Optional[str] = Field(description="The model answer content if available for that section; omit if the content belongs to its sub-sections")
+    marking_criteria: Optional[str] = Field(None, description="Marking criteria details if available; omit if it belongs to sub sections")
+    total_marks_available: Optional[str] = Field(None, description="Total marks available for this part; omit if belong to subsections")
+    maximum_marks: Optional[str] = Field(None, description="Maximum full marks (if stated); omit if belong to sub sections")
+    sub_answers: Optional[List["SubAnswer"]] = Field(
+        None,
+        description="Nested sub-answers if the subquestion has further divisions like a), b), etc."
+    )
+
+class ModelAnswerExtraction(BaseModel):
+    question_title: str = Field(description="Main question title, e.g., 'Question 1'")
+    description: Optional[str] = Field(None, description="Introductory paragraph or assumption if given")
+    answers: List[SubAnswer] = Field(..., description="List of main answers or sub-sections like 1.1, 1.2, etc.")
+    total_marks: Optional[str] = Field(None, description="Total marks for this main question if mentioned")
+
+
+# Question extraction (question paper)
+class SubQuestion(BaseModel):
+    question_number: str = Field(description="Subquestion number like '1.1' or 'a)'")
+    content: str = Field(description="Full content of the subquestion")
+    marks: Optional[str] = Field(None, description="Marks for this subquestion, e.g., '5 marks'")
+
+class QuestionExtraction(BaseModel):
+    question_title: str = Field(description="Main question title (e.g., 'Question 1')")
+    description: Optional[str] = Field(None, description="Introductory description or assumptions")
+    questions: List[SubQuestion] = Field(..., description="List of subquestions or single main question")
+    total_marks: Optional[str] = Field(None, description="Total marks for this main question")
+
+
+# Student answer extraction, mapping and grading
+class SubPart(BaseModel):
+    question_number: str = Field(description="The identifier of the subsection or scenario (e.g., '1.1' or 'a)')")
+    answer: str = Field(description="content paragraphs from the student's answer for marking criteria")
+
+class StudentAnswerExtraction(BaseModel):
+    question: str = Field(description="The main question number (e.g., '1' or '4')")
+    sub_parts: List[SubPart] = Field(description="List of subsections with their content, only if subsections like 1.1, a), A) are present")
+
+class MappingItem(BaseModel):
+    chunk_id: int = Field(..., description="Identifier of the student answer chunk.")
+    mapped_question_number: str = Field(..., description="The matched question number, e.g., '1.1', or '0' if unmapped.")
+
+class MappingList(BaseModel):
+    mappings: List[MappingItem]
+
+class GradingItem(BaseModel):
+    # The grader emits score/total_marks as JSON numbers; keep them as strings
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
+    question_number: str = Field(..., description="The number of the question/sub-question, e.g., '1.1'.")
+    score: str = Field(..., description="Marks obtained by the student, e.g., '3'.")
+    total_marks: str = Field(..., description="Total marks for the question, e.g., '5', from maximum_marks, only include integer value nothing else like marks and other words.")
+    comment: str = Field(..., description="Feedback comment for the student, Should be concise but covering what went wrong and to the point, should not exceed three lines")
+    correct_lines: List[str] = Field(..., description="Exact lines from the student's answer that are deemed correct, should be exact matching with same wording and everything")
+    correct_words: List[str] = Field(..., description="Exact words from the student's answer explaining why the lines are correct.")
+
+class GradingList(BaseModel):
+    grades: List[GradingItem]
+
+class StudentGrading(BaseModel):
+    student_id: str = Field(..., description="Identifier of the student exactly as given in the batch.")
+    grades: List[GradingItem]
+
+class BatchGradingList(BaseModel):
+    results: List[StudentGrading]